@@ -1,6 +1,6 @@
 import sys
 import os
-from qbay.database import db, app
+from qbay.database import db
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
@@ -10,7 +10,5 @@ templates = os.path.join(SCRIPT_DIR, "templates")
 an init file is required for this folder to be considered as a module
 '''
 
-# Drop existing database and create new instance
-with app.app_context():
-    db.drop_all()
-    db.create_all()
+# The Flask app and its database engine are built on first use, see
+# database.create_app; the schema is created or upgraded at that point.
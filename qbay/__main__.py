@@ -1,8 +1,90 @@
-from qbay import *
-from qbay.database import app
-from qbay.controllers import *
+import argparse
+import sys
+from qbay import importer, ledger, migrations, server
+from qbay.database import create_app, get_app, db
 
 FLASK_PORT = 8081
 
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m qbay')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help='run the development server (default)')
+    serve = commands.add_parser('serve',
+                                help='run the pre-forking production server')
+    serve.add_argument('--host', default='0.0.0.0')
+    serve.add_argument('--port', type=int, default=FLASK_PORT)
+    serve.add_argument('--workers', type=int, default=None,
+                       help='worker processes (default: CPU count)')
+    serve.add_argument('--threads', type=int, default=4,
+                       help='request threads per worker')
+    serve.add_argument('--max-requests', type=int, default=1000,
+                       help='requests before a worker is recycled, 0 for '
+                            'never')
+    commands.add_parser('migrate',
+                        help='upgrade the database schema to the latest '
+                             'version')
+    reset = commands.add_parser('reset-db',
+                                help='drop ALL data and recreate the schema')
+    reset.add_argument('--yes', action='store_true',
+                       help='do not ask for confirmation')
+    load = commands.add_parser('import',
+                               help='bulk import records from a CSV or JSON '
+                                    'Lines file')
+    load.add_argument('kind', choices=importer.KINDS)
+    load.add_argument('path')
+    load.add_argument('--format', choices=('csv', 'jsonl'), default=None,
+                      help='file format (default: from the file extension)')
+    load.add_argument('--batch-size', type=int, default=1000,
+                      help='records validated and written per transaction')
+    commands.add_parser('reconcile',
+                        help='check every balance against the balance '
+                             'ledger')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        return server.serve(args.host, args.port, args.workers,
+                            args.threads, args.max_requests)
+    elif args.command == 'migrate':
+        app = create_app({'QBAY_BOOTSTRAP_SCHEMA': False})
+        with app.app_context():
+            applied = migrations.upgrade(db.engine)
+        print(f"Applied migrations: {applied}" if applied
+              else "Database schema is up to date")
+    elif args.command == 'reset-db':
+        if not args.yes:
+            answer = input("This deletes all qbay data. Continue? [y/N] ")
+            if answer.strip().lower() != 'y':
+                return 1
+        app = create_app({'QBAY_BOOTSTRAP_SCHEMA': False})
+        with app.app_context():
+            migrations.reset(db.engine)
+        print("Database reset")
+    elif args.command == 'import':
+        try:
+            with get_app().app_context():
+                report = importer.import_file(args.kind, args.path,
+                                              args.format,
+                                              max(args.batch_size, 1))
+        except OSError as e:
+            print(f"Cannot read {args.path}: {e.strerror}", file=sys.stderr)
+            return 2
+        for line, message in report.errors:
+            print(f"{args.path}:{line}: {message}", file=sys.stderr)
+        print(report.summary())
+        return 1 if report.errors else 0
+    elif args.command == 'reconcile':
+        with get_app().app_context():
+            checked, mismatches = ledger.reconcile()
+        for user_id, balance, total in mismatches:
+            print(f"User {user_id}: balance {balance}, ledger total {total}",
+                  file=sys.stderr)
+        print(f"Checked {checked} balances, {len(mismatches)} mismatched")
+        return 1 if mismatches else 0
+    else:
+        get_app().run(debug=True, port=FLASK_PORT, host='0.0.0.0')
+    return 0
+
+
 if __name__ == "__main__":
-    app.run(debug=True, port=FLASK_PORT, host='0.0.0.0')
\ No newline at end of file
+    sys.exit(main())
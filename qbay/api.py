@@ -0,0 +1,187 @@
+# api.py
+"""
+Read-only JSON API, version 1.
+
+Every response carries a strong ETag computed from the rows it is built
+from: a listing's editable columns, last_modified_date and owner's
+username, and for availability its booked ranges. A client repeating a
+request with If-None-Match gets an empty 304 whenever nothing it depends
+on has changed, without the body being serialized again.
+"""
+import hashlib
+from datetime import datetime
+from flask import Blueprint, current_app, jsonify, request, url_for
+
+from qbay import database
+from qbay.listing import Listing
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def etag(*parts):
+    """Returns an entity tag identifying the given values"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def conditional(tag, build):
+    """Answers 304 if the client already holds tag, otherwise returns
+    build() as JSON tagged with it.
+    """
+    if request.if_none_match.contains(tag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(tag)
+    # Clients may keep the body but must revalidate before reusing it
+    response.cache_control.no_cache = True
+    return response
+
+
+def error(message, status):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+def listing_version(listing: database.Listing):
+    """The values of a listing a client can see change, including its
+    owner's username, which listing_json shows
+    """
+    return (listing.id, listing.title, listing.description, listing.price,
+            listing.address, listing.last_modified_date, listing.owner_id,
+            listing.owner.username)
+
+
+def listing_json(listing: database.Listing):
+    return {
+        'id': listing.id,
+        'title': listing.title,
+        'description': listing.description,
+        'price': listing.price / 100,
+        'address': listing.address,
+        'date_created': listing.date_created,
+        'last_modified_date': listing.last_modified_date,
+        'owner': {'id': listing.owner.id,
+                  'username': listing.owner.username},
+        'url': url_for('api.listing', listing_id=listing.id),
+    }
+
+
+def page_size():
+    return min(max(request.args.get('size', 20, type=int), 1), 100)
+
+
+@api.route('/listings')
+def listings():
+    """Lists listings, newest first by default.
+
+    With q, ranks listings by full-text relevance; with start and end
+    (YYYY-MM-DD, end exclusive), lists listings free for that stay,
+    optionally filtered by min_price and max_price and ordered by sort.
+    The feed pages with after/before cursors, the others with page.
+    """
+    size = page_size()
+    args = {k: v for k, v in request.args.items()
+            if k not in ('after', 'before', 'page')}
+    prev_url = next_url = None
+
+    if 'start' in request.args or 'end' in request.args:
+        page = max(request.args.get('page', 1, type=int), 1)
+        try:
+            rows, has_next = Listing.available(
+                request.args.get('start', ''), request.args.get('end', ''),
+                request.args.get('min_price', type=float),
+                request.args.get('max_price', type=float),
+                request.args.get('sort', 'price'), page, size)
+        except ValueError as e:
+            return error(str(e), 400)
+    elif 'q' in request.args:
+        page = max(request.args.get('page', 1, type=int), 1)
+        rows, has_next = Listing.search(request.args['q'], page, size)
+    else:
+        page = None
+        rows, prev_cursor, next_cursor = Listing.feed_page(
+            size, after=request.args.get('after'),
+            before=request.args.get('before'))
+        if prev_cursor:
+            prev_url = url_for('api.listings', before=prev_cursor, **args)
+        if next_cursor:
+            next_url = url_for('api.listings', after=next_cursor, **args)
+
+    if page is not None:
+        if page > 1:
+            prev_url = url_for('api.listings', page=page - 1, **args)
+        if has_next:
+            next_url = url_for('api.listings', page=page + 1, **args)
+
+    tag = etag(prev_url, next_url, [listing_version(row) for row in rows])
+    return conditional(tag, lambda: {
+        'listings': [listing_json(row) for row in rows],
+        'prev': prev_url,
+        'next': next_url,
+    })
+
+
+@api.route('/listings/<int:listing_id>')
+def listing(listing_id):
+    row = database.Listing.query.get(listing_id)
+    if row is None:
+        return error("Listing not found", 404)
+    return conditional(etag(listing_version(row)),
+                       lambda: listing_json(row))
+
+
+@api.route('/listings/<int:listing_id>/availability')
+def availability(listing_id):
+    """Reports the booked ranges of a listing from today on and the first
+    date it can be booked from. With start and end, also reports whether
+    that stay is free.
+    """
+    listing = Listing.query_listing(listing_id)
+    if listing is None:
+        return error("Listing not found", 404)
+    today = datetime.now().strftime('%Y-%m-%d')
+    stay = None
+    if 'start' in request.args or 'end' in request.args:
+        try:
+            stay = tuple(datetime.strptime(
+                request.args.get(key, ''), '%Y-%m-%d').strftime('%Y-%m-%d')
+                for key in ('start', 'end'))
+        except ValueError:
+            return error("start and end must be dates as YYYY-MM-DD", 400)
+        if stay[0] >= stay[1]:
+            return error("Start date is same or after end date!", 400)
+
+    booked = [(start, end) for start, end in listing.booked_ranges
+              if end > today]
+
+    def build():
+        body = {
+            'listing_id': listing_id,
+            'booked': [{'start': start, 'end': end}
+                       for start, end in booked],
+            'next_available': listing.find_min_booking_date(),
+        }
+        if stay:
+            body['available'] = listing.is_available(*stay)
+        return body
+
+    return conditional(etag(listing_id, today, stay, booked), build)
+
+
+@api.route('/titles/available')
+def title_available():
+    """Reports whether a listing could be created with the given title,
+    for the create listing form to check as the user types. Asks the
+    database, as the title filter may miss titles taken by other workers.
+    """
+    title = request.args.get('title', '')
+    reason = None
+    if not Listing.valid_title_format(title):
+        reason = "Invalid title"
+    elif Listing.title_taken(title, exact=True):
+        reason = "Title already exists"
+    response = jsonify({'title': title, 'available': reason is None,
+                        'reason': reason})
+    response.cache_control.no_store = True
+    return response
@@ -1,8 +1,8 @@
 # booking.py
 from enum import Enum, unique
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import TYPE_CHECKING, Union
-from qbay import database
+from qbay import database, ledger
 from qbay.database import db
 from qbay.user import User
 from qbay.listing import Listing
@@ -99,40 +99,65 @@ class Booking:
         if book_start >= book_end:
             raise ValueError("Start date is same or after end date!")
   
-        buyer = User.query_user(buyer_id)
-        if not buyer:
-            raise ValueError("Invalid Buyer ID: " + str(buyer_id))
-        listing = Listing.query_listing(listing_id)
-        if not listing:
-            raise ValueError("Invalid Listing ID: " + str(listing_id))
-        owner = User.query_user(owner_id)
-        if not owner:
-            raise ValueError("Invalid Owner ID: " + str(owner_id))
-
-        # Get all dates in the booking range given, excluding end date
+        # Booked nights are the half-open range [start, end)
         # (buyer leaves on final date's morning)
         start = datetime.strptime(book_start, "%Y-%m-%d")
         end = datetime.strptime(book_end, "%Y-%m-%d")
         nights_booked = (end - start).days
-        booked_dates = [start + timedelta(days=x)
-                        for x in range(0, nights_booked)]
+        book_start = start.strftime("%Y-%m-%d")
+        book_end = end.strftime("%Y-%m-%d")
 
-        cost = listing.price * nights_booked
-        if buyer.balance < cost:
-            raise ValueError("Buyer's balance is too low for this booking!")
-
-        # To book, update listing booking date
-        listing.valid_booking_date(booked_dates)
-        listing.add_booking_date(booked_dates)
+        # The availability check, date claim, balance transfer and booking
+        # row are one transaction. The listing stays locked until it
+        # commits so concurrent bookings of it cannot interleave; balances
+        # move through atomic ledger updates, so the users are not locked.
+        try:
+            database.begin_write()
+            listing = Listing.query_listing(listing_id, for_update=True)
+            buyer = User.query_user(buyer_id)
+            owner = User.query_user(owner_id)
+
+            if not buyer:
+                raise ValueError("Invalid Buyer ID: " + str(buyer_id))
+            if not listing:
+                raise ValueError("Invalid Listing ID: " + str(listing_id))
+            if not owner:
+                raise ValueError("Invalid Owner ID: " + str(owner_id))
+
+            # Balances move in whole cents, as prices are stored
+            cost = round(listing.database_obj.price) * nights_booked
+            if buyer.database_obj.balance < cost:
+                raise ValueError(
+                    "Buyer's balance is too low for this booking!")
+
+            if not listing.is_available(book_start, book_end):
+                raise ValueError(
+                    "Given dates overlap with existing bookings!")
+            listing.claim_range(book_start, book_end)
+
+            booking = database.Booking(buyer_id=buyer_id,
+                                       owner_id=owner_id,
+                                       listing_id=listing_id,
+                                       start_date=book_start,
+                                       end_date=book_end)
+            db.session.add(booking)
+            db.session.flush()
+            # The balance check above is repeated in the debit itself, in
+            # case a concurrent payment got there first
+            if not ledger.transfer(buyer_id, owner_id, cost, ledger.BOOKING,
+                                   booking.id):
+                raise ValueError(
+                    "Buyer's balance is too low for this booking!")
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            User.invalidate_cache(buyer_id)
+            User.invalidate_cache(owner_id)
 
         # Add this listing to buyer's list of bookings
         buyer.add_booking(listing)
-
-        # Update buyer and owner balance
-        buyer.update_balance(buyer.balance - cost)
-        owner.update_balance(owner.balance + cost)
-        booking = Booking(buyer_id, owner_id, listing_id, book_start, book_end)
-        booking.add_to_database()
         return True
     
     def add_to_database(self):
@@ -143,7 +168,7 @@ class Booking:
                                    end_date=self.end_date)
 
         try:
-            with database.app.app_context():
+            with database.app_context():
                 db.session.add(booking)
                 db.session.commit()
                 self._id = booking.id
@@ -0,0 +1,123 @@
+# cache.py
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread-safe, size-bounded cache that evicts the least recently
+    used entry, with an optional time-to-live per entry.
+
+    params:
+    - maxsize: Most entries kept before evicting (int)
+    - ttl: Seconds an entry stays valid, None to never expire (float)
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if it is missing
+        or expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= now):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Caches value under key, evicting the least recently used entry
+        if the cache is full.
+        """
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """Removes key from the cache if present"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self, counters=True):
+        """Removes every entry and, unless counters is False, resets the
+        hit and miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            if counters:
+                self.hits = 0
+                self.misses = 0
+
+    def stats(self):
+        """Returns the entry count, capacity and hit and miss counters"""
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class BloomFilter:
+    """A thread-safe probabilistic set of strings. Membership tests may
+    give false positives but never false negatives, and entries cannot be
+    removed.
+
+    params:
+    - capacity: Entries the filter is sized for (int)
+    - error_rate: False positive rate once capacity entries are added
+      (float)
+    """
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.bits = max(int(-self.capacity * math.log(error_rate) /
+                            math.log(2) ** 2), 8)
+        self.hashes = max(round(self.bits / self.capacity * math.log(2)), 1)
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, key: str):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, key: str):
+        """Adds key to the filter"""
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                self._array[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key: str):
+        return all(self._array[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    @property
+    def full(self):
+        """Whether more entries than the filter is sized for were added"""
+        return self.count > self.capacity
@@ -1,12 +1,37 @@
 from distutils.log import error
-from flask import render_template, request, session, redirect
-from qbay.user import User
-from qbay.listing import Listing
-from qbay import database
-from qbay.database import app
-from qbay.booking import Booking
+from flask import (Blueprint, abort, current_app, g, jsonify,
+                   render_template, request, session, redirect, url_for)
+from markupsafe import Markup
+from qbay.user import User, user_cache
+from qbay.listing import Listing, card_cache, feed_cache
+from qbay import database, metrics, profiler
+from qbay.dispatcher import get_dispatcher
 
 from functools import wraps
+from sqlalchemy.orm import joinedload
+
+# Registered on every app built by database.create_app
+routes = Blueprint('qbay', __name__)
+
+
+@routes.before_app_request
+def forget_user():
+    # g belongs to the app context, which outlives the request when one was
+    # already pushed (as in tests)
+    g.pop('user', None)
+
+
+def current_user():
+    """Returns the logged in User for this request, or None.
+
+    The user is looked up at most once per request, and comes from the
+    process-wide user cache when it is warm.
+    """
+    if 'user' not in g:
+        g.user = None
+        if 'logged_in' in session:
+            g.user = User.query_user(session['logged_in'], cached=True)
+    return g.user
 
 
 def authenticate(inner_function):
@@ -14,7 +39,7 @@ def authenticate(inner_function):
     :param inner_function: any python function that accepts a user object
     Wrap any python function and check the current session to see if 
     the user has logged in. If login, it will call the inner_function
-    with the logged in user object.
+    with the logged in user object, followed by any route arguments.
     To wrap a function, we can put a decoration on that function.
     Example:
     @authenticate
@@ -23,20 +48,19 @@ def authenticate(inner_function):
     """
 
     @wraps(inner_function)
-    def wrapped_inner():
+    def wrapped_inner(*args, **kwargs):
         # check did we store the key in the session
         if 'logged_in' in session:
-            id = session['logged_in']
             try:
                 # This generates a new User object that can interact with
                 # the database via some tethering.
                 # You want to use this object to pass around the program as it
                 # has the needed functions for actually managing the database
-                user = User.query_user(id)
+                user = current_user()
                 if user:
                     # if the user exists, call the inner_function
                     # with user as parameter
-                    return inner_function(user)
+                    return inner_function(user, *args, **kwargs)
                 return redirect('/login')
             except Exception:
                 pass
@@ -48,19 +72,64 @@ def authenticate(inner_function):
     return wrapped_inner
 
 
-@app.route('/')
+def listing_cards(ids, rows=()):
+    """Returns the rendered cards of the listings with the given ids, in
+    order. Cards missing from the card cache are rendered from rows, or
+    from one query for those not in rows, and cached.
+    """
+    cards = {id: card_cache.get(id) for id in ids}
+    missing = [id for id, card in cards.items() if card is None]
+    if missing:
+        loaded = {row.id: row for row in rows if row.id in missing}
+        if len(loaded) < len(missing):
+            loaded.update((row.id, row) for row in
+                          database.Listing.query.options(
+                              joinedload(database.Listing.owner)).filter(
+                              database.Listing.id.in_(missing)))
+        for id in missing:
+            if id in loaded:
+                cards[id] = Markup(render_template('listing_card.html',
+                                                   listing=loaded[id]))
+                card_cache.put(id, cards[id])
+    return [cards[id] for id in ids if cards[id] is not None]
+
+
+@routes.route('/')
 @authenticate
 def home(user):
-    listings = database.Listing.query.all()
-    return render_template('index.html', user=user, listings=listings)
+    size = min(max(request.args.get('size', 20, type=int), 1), 100)
+    key = (size, request.args.get('after'), request.args.get('before'))
+    rows = ()
+    page = feed_cache.get(key)
+    if page is None:
+        rows, prev_cursor, next_cursor = Listing.feed_page(
+            size, after=key[1], before=key[2])
+        page = ([row.id for row in rows], prev_cursor, next_cursor)
+        feed_cache.put(key, page)
+    ids, prev_cursor, next_cursor = page
+    return render_template('index.html', user=user,
+                           cards=listing_cards(ids, rows), size=size,
+                           prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+
+@routes.route('/search')
+@authenticate
+def search(user):
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    size = min(max(request.args.get('size', 20, type=int), 1), 100)
+    listings, has_next = Listing.search(query, page, size)
+    return render_template('search.html', user=user, listings=listings,
+                           query=query, page=page, size=size,
+                           has_next=has_next)
 
 
-@app.route('/login', methods=['GET'])
+@routes.route('/login', methods=['GET'])
 def login_get():
     return render_template('login.html', message='')
 
 
-@app.route('/login', methods=['POST'])
+@routes.route('/login', methods=['POST'])
 def login_post():
     email = request.form.get('email')
     password = request.form.get('password')
@@ -89,20 +158,20 @@ def login_post():
                                prevEmail=email)
 
 
-@app.route('/logout')
+@routes.route('/logout')
 def logout():
     if 'logged_in' in session:
         session.pop('logged_in', None)
     return redirect('/')
 
 
-@app.route('/register', methods=['GET'])
+@routes.route('/register', methods=['GET'])
 def register_get():
     # templates are stored in the templates folder
     return render_template('register.html', message='')
 
 
-@app.route('/register', methods=['POST'])
+@routes.route('/register', methods=['POST'])
 def register_post():
     email = request.form.get('email')
     username = request.form.get('username')
@@ -126,7 +195,7 @@ def register_post():
         return redirect('/login')
 
 
-@app.route('/user_update', methods=['GET'])
+@routes.route('/user_update', methods=['GET'])
 @authenticate
 def update_informations_get(user: User):
     return render_template('/user_update.html', user=user, errors='', 
@@ -135,7 +204,7 @@ def update_informations_get(user: User):
                            prevPostalCode=user.postal_code)
 
 
-@app.route('/user_update', methods=['POST'])
+@routes.route('/user_update', methods=['POST'])
 @authenticate
 def update_informations_post(user: User):
     """Update the user information from the HTML page
@@ -185,56 +254,83 @@ def update_informations_post(user: User):
                            prevPostalCode=postal_code)
 
 
-@app.route('/booking/<int:listing_id>', methods=['GET'])
-def booking_get(listing_id):
+@routes.route('/booking/<int:listing_id>', methods=['GET'])
+@authenticate
+def booking_get(user, listing_id):
     listing = database.Listing.query.filter_by(id=listing_id).first()
     listing_obj = Listing.query_listing(listing_id)
-    user = database.User.query.filter_by(id=session["logged_in"]).first()
     min_date = listing_obj.find_min_booking_date()
     return render_template('booking.html', listing=listing, user=user, 
                            min_date=min_date, message='')
 
 
-@app.route('/booking/<int:listing_id>', methods=['POST'])
-def booking_post(listing_id):
-    user = database.User.query.filter_by(id=session["logged_in"]).first()
+@routes.route('/booking/<int:listing_id>', methods=['POST'])
+@authenticate
+def booking_post(user, listing_id):
+    """Queues the booking on the booking dispatcher and waits for it, or
+    with ?wait=0 answers 202 with the ticket to poll.
+    """
     buyer = user.id
     listing = database.Listing.query.filter_by(id=listing_id).first()
     listing_obj = Listing.query_listing(listing_id)
     seller = listing.owner_id
     start_date = request.form.get('trip-start')
     end_date = request.form.get('trip-end')
-    
-    try:
-        Booking.book_listing(buyer, seller, listing_id, start_date, end_date)
+
+    ticket = get_dispatcher(current_app._get_current_object()).submit(
+        buyer, seller, listing_id, start_date, end_date)
+    status_url = url_for('qbay.booking_status', ticket_id=ticket.id)
+    if request.args.get('wait') == '0':
+        response = jsonify(ticket.to_dict())
+        response.status_code = 202
+        response.headers['Location'] = status_url
+        return response
+
+    if not ticket.wait(current_app.config['QBAY_BOOKING_WAIT']):
+        message = "Booking is being processed, see " + status_url
+    elif ticket.status == 'booked':
         message = "Booking Successful: " + start_date + " to " + end_date
-    except ValueError as e:
-        message = str(e)
+    else:
+        message = ticket.message
+    # End this request's transaction so the booking is visible
+    database.db.session.rollback()
     min_date = listing_obj.find_min_booking_date()
 
     return render_template('booking.html', listing=listing, user=user, 
                            min_date=min_date, message=message)
 
 
-@app.route('/user_bookings')
+@routes.route('/booking/status/<ticket_id>')
+@authenticate
+def booking_status(user, ticket_id):
+    ticket = get_dispatcher(current_app._get_current_object()).status(
+        ticket_id)
+    if ticket is None or ticket.buyer_id != user.id:
+        response = jsonify({'error': "Unknown booking"})
+        response.status_code = 404
+        return response
+    return jsonify(ticket.to_dict())
+
+
+@routes.route('/user_bookings')
 @authenticate
 def view_user_bookings(user):
-    listings = []
-    bookings = database.Booking.query.filter_by(buyer_id=user.id).all()
-    for booking in bookings:
-        listing = database.Listing.query.get(booking.listing_id)
-        listings.append(listing)
+    # Load each booking with its listing and the listing's owner up front
+    bookings = database.Booking.query.filter_by(buyer_id=user.id).options(
+        joinedload(database.Booking.listing).joinedload(
+            database.Listing.owner)).all()
+    listings = [booking.listing for booking in bookings]
 
     return render_template('user_bookings.html', bookings=bookings, 
                            listings=listings)
 
 
-@app.route('/create_listing', methods=['GET'])
+@routes.route('/create_listing', methods=['GET'])
 def create_listing_get():
     return render_template('create_listing.html', message='')
 
 
-@app.route('/create_listing', methods=['POST'])
+@routes.route('/create_listing', methods=['POST'])
 @authenticate
 def create_listing_post(user):
     title = request.form.get('title')
@@ -257,17 +353,17 @@ def create_listing_post(user):
     return redirect('/')
 
 
-@app.route('/user_listings')
+@routes.route('/user_listings')
 @authenticate
 def view_user_listings(user):
     listings = database.Listing.query.filter_by(owner_id=user.id).all()
     return render_template('user_listings.html', listings=listings)
 
 
-@app.route('/update_listing/<int:listing_id>', methods=['GET'])
-def update_listing_get(listing_id):
+@routes.route('/update_listing/<int:listing_id>', methods=['GET'])
+@authenticate
+def update_listing_get(user, listing_id):
     listing = database.Listing.query.get(listing_id)
-    user = database.User.query.filter_by(id=session["logged_in"]).first()
     return render_template('/update_listing.html',
                            user=user, listing=listing, errors='',
                            prevTitle=listing.title, 
@@ -276,7 +372,7 @@ def update_listing_get(listing_id):
                            prevAddress=listing.address)
 
 
-@app.route('/update_listing/<int:listing_id>', methods=['POST'])
+@routes.route('/update_listing/<int:listing_id>', methods=['POST'])
 def update_listing_post(listing_id):
     listing = Listing.query_listing(listing_id)  # Listing obj linked to db obj
     title = request.form.get('title')
@@ -320,4 +416,57 @@ def update_listing_post(listing_id):
                            listing=listing.database_obj, messages=messages,
                            prevTitle=title, prevDescription=description, 
                            prevPrice=price, prevAddress=address)
-    
\ No newline at end of file
+
+
+@routes.route('/metrics')
+def metrics_page():
+    app = current_app._get_current_object()
+    if not app.config['QBAY_METRICS']:
+        abort(404)
+    return app.response_class(metrics.render(metrics.collect(app)),
+                              content_type=metrics.CONTENT_TYPE)
+
+
+def debug_endpoint(inner_function):
+    """Hides a route unless QBAY_DEBUG_ENDPOINTS is enabled and the request
+    comes from this machine.
+    """
+
+    @wraps(inner_function)
+    def wrapped_inner(*args, **kwargs):
+        if not (current_app.config['QBAY_DEBUG_ENDPOINTS'] and
+                request.remote_addr in ('127.0.0.1', '::1')):
+            abort(404)
+        return inner_function(*args, **kwargs)
+
+    return wrapped_inner
+
+
+@routes.route('/debug/pool')
+@debug_endpoint
+def debug_pool():
+    return jsonify(database.pool_stats())
+
+
+@routes.route('/debug/bookings')
+@debug_endpoint
+def debug_bookings():
+    dispatcher = get_dispatcher(current_app._get_current_object())
+    return jsonify({'pending': dispatcher.pending(),
+                    'tickets': dispatcher.tickets.stats()})
+
+
+@routes.route('/debug/cache')
+@debug_endpoint
+def debug_cache():
+    return jsonify({'users': user_cache.stats(), 'feed': feed_cache.stats(),
+                    'cards': card_cache.stats()})
+
+
+@routes.route('/debug/profile')
+@debug_endpoint
+def debug_profile():
+    app = current_app._get_current_object()
+    return jsonify({'enabled': app.config['QBAY_PROFILE'],
+                    'window_seconds': app.config['QBAY_PROFILE_WINDOW'],
+                    'slowest': profiler.slowest(app)})
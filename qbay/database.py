@@ -1,28 +1,262 @@
 import os
-from flask import Flask
+import threading
+import time
+from flask import Flask, current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 
 from sqlalchemy.sql import func
-from sqlalchemy import Column, ForeignKey, Integer, Table
+from sqlalchemy import DDL, Column, ForeignKey, Integer, Table, event, exc
 import sqlalchemy.types
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import relationship
+from sqlalchemy.pool import QueuePool
 
 import datetime
+import itertools
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-app = Flask(__name__)
-db_string = os.getenv('db_string')
-if db_string:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_string
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] =\
-        'sqlite:///' + os.path.join(basedir, 'qbay_database.db')
+db = SQLAlchemy()
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = '69cae04b04756f65eabcd2c5a11c8c24'
+_app = None
+_app_lock = threading.Lock()
 
-db = SQLAlchemy(app)
+
+def default_config():
+    """Returns the configuration used when create_app is given none"""
+    db_string = os.getenv('db_string')
+    if not db_string:
+        db_string = 'sqlite:///' + os.path.join(basedir, 'qbay_database.db')
+    return {
+        'SQLALCHEMY_DATABASE_URI': db_string,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SECRET_KEY': '69cae04b04756f65eabcd2c5a11c8c24',
+        # Create or upgrade the schema when the app is created
+        'QBAY_BOOTSTRAP_SCHEMA': True,
+        # Connection pool, ignored for in-memory SQLite
+        'QBAY_DB_POOL_SIZE': int(os.getenv('db_pool_size', 5)),
+        'QBAY_DB_MAX_OVERFLOW': int(os.getenv('db_max_overflow', 10)),
+        'QBAY_DB_POOL_TIMEOUT': float(os.getenv('db_pool_timeout', 30)),
+        'QBAY_DB_POOL_RECYCLE': int(os.getenv('db_pool_recycle', 1800)),
+        'QBAY_DB_POOL_PRE_PING':
+            os.getenv('db_pool_pre_ping', '1').lower() in ('1', 'true'),
+        # Milliseconds; MySQL aborts longer SELECTs, 0 disables the limit
+        'QBAY_DB_STATEMENT_TIMEOUT':
+            int(os.getenv('db_statement_timeout', 0)),
+        # Milliseconds SQLite waits on a locked database before failing
+        'QBAY_DB_BUSY_TIMEOUT': int(os.getenv('db_busy_timeout', 5000)),
+        # Threads running bookings, see qbay/dispatcher.py, and seconds a
+        # booking request waits for its result
+        'QBAY_BOOKING_WORKERS': int(os.getenv('booking_workers', 4)),
+        'QBAY_BOOKING_WAIT': float(os.getenv('booking_wait', 10)),
+        # Time every request, see qbay/profiler.py: how many of the
+        # slowest to keep, and for how many seconds
+        'QBAY_PROFILE': os.getenv('profile', '0').lower() in ('1', 'true'),
+        'QBAY_PROFILE_SLOWEST': int(os.getenv('profile_slowest', 50)),
+        'QBAY_PROFILE_WINDOW': float(os.getenv('profile_window', 300)),
+        # Log slow statements and N+1 query patterns, see
+        # qbay/diagnostics.py: from how many milliseconds a statement is
+        # slow, and how many runs of one statement in a request are N+1
+        'QBAY_DIAGNOSTICS':
+            os.getenv('diagnostics', '0').lower() in ('1', 'true'),
+        'QBAY_SLOW_QUERY_MS': float(os.getenv('slow_query_ms', 100)),
+        'QBAY_N_PLUS_ONE': int(os.getenv('n_plus_one', 10)),
+        # Serve /metrics, see qbay/metrics.py; the directory where each
+        # server process writes its values for the others to add up
+        'QBAY_METRICS': os.getenv('metrics', '1').lower() in ('1', 'true'),
+        'QBAY_METRICS_DIR': os.getenv('metrics_dir') or None,
+        # Serve /debug/* pages to requests from this machine
+        'QBAY_DEBUG_ENDPOINTS':
+            os.getenv('debug_endpoints', '0').lower() in ('1', 'true'),
+    }
+
+
+class StatsQueuePool(QueuePool):
+    """QueuePool that counts checkouts, checkouts that had to wait for a
+    connection to be returned, overflow connections opened and checkouts
+    that timed out.
+    """
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kwargs):
+        super().__init__(creator, pool_size=pool_size,
+                         max_overflow=max_overflow, **kwargs)
+        self.overflow_limit = max_overflow
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.overflows = 0
+        self.timeouts = 0
+
+    def _do_get(self):
+        # Counters are best effort; they are not locked against each other
+        self.checkouts += 1
+        full = self.checkedin() == 0 and \
+            0 <= self.overflow_limit <= self.overflow()
+        overflow = self.overflow()
+        began = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            if full:
+                self.waits += 1
+                self.wait_seconds += time.perf_counter() - began
+            if self.overflow() > max(overflow, 0):
+                self.overflows += 1
+
+
+def engine_options(config):
+    """Builds SQLAlchemy engine options from the QBAY_DB_* settings"""
+    options = {
+        'pool_pre_ping': config['QBAY_DB_POOL_PRE_PING'],
+        'pool_recycle': config['QBAY_DB_POOL_RECYCLE'],
+    }
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite' and \
+            url.database in (None, '', ':memory:'):
+        # An in-memory database lives in a single shared connection
+        return options
+    options.update(poolclass=StatsQueuePool,
+                   pool_size=config['QBAY_DB_POOL_SIZE'],
+                   max_overflow=config['QBAY_DB_MAX_OVERFLOW'],
+                   pool_timeout=config['QBAY_DB_POOL_TIMEOUT'])
+    return options
+
+
+def _configure_connections(engine, config):
+    """Applies per-connection settings every time the pool connects"""
+    backend = engine.dialect.name
+
+    @event.listens_for(engine, 'connect')
+    def configure(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        if backend == 'sqlite':
+            # WAL lets readers carry on while a booking commits
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute(
+                f"PRAGMA busy_timeout={int(config['QBAY_DB_BUSY_TIMEOUT'])}")
+        elif backend == 'mysql' and config['QBAY_DB_STATEMENT_TIMEOUT']:
+            cursor.execute('SET SESSION max_execution_time = %s' %
+                           int(config['QBAY_DB_STATEMENT_TIMEOUT']))
+        cursor.close()
+
+
+def pool_stats(engine=None):
+    """Returns a snapshot of the connection pool of the given engine, or of
+    the active app's engine.
+
+    Gauges: size, checked_in, checked_out, overflow (connections open
+    beyond size). Counters since the pool was created: checkouts, waits,
+    wait_seconds, overflows, timeouts.
+    """
+    pool = (engine or db.engine).pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_in=pool.checkedin(),
+                     checked_out=pool.checkedout(),
+                     overflow=max(pool.overflow(), 0))
+    if isinstance(pool, StatsQueuePool):
+        stats.update(checkouts=pool.checkouts, waits=pool.waits,
+                     wait_seconds=round(pool.wait_seconds, 6),
+                     overflows=pool.overflows, timeouts=pool.timeouts)
+    return stats
+
+
+def create_app(config=None):
+    """Creates a Flask app serving qbay with its own database binding.
+
+    params:
+    - config: Settings overriding default_config() (dict)
+
+    Several apps can live in one process, e.g. to run benchmarks or
+    workers against isolated databases.
+    """
+    from qbay import (api, controllers, diagnostics, metrics, migrations,
+                      profiler)
+
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(app.config))
+    db.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    diagnostics.init_app(app)
+    app.register_blueprint(controllers.routes)
+    app.register_blueprint(api.api)
+
+    with app.app_context():
+        _configure_connections(db.engine, app.config)
+
+    if app.config['QBAY_BOOTSTRAP_SCHEMA']:
+        with app.app_context():
+            migrations.upgrade(db.engine)
+    return app
+
+
+def get_app():
+    """Returns the process-wide default app, creating it on first use"""
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                _app = create_app()
+    return _app
+
+
+def app_context():
+    """Returns a new app context for the active app, or for the default app
+    when no app context is active.
+    """
+    if has_app_context():
+        return current_app._get_current_object().app_context()
+    return get_app().app_context()
+
+
+def __getattr__(name):
+    # `database.app` is the default app, only built when first accessed so
+    # importing the models stays cheap
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def begin_write():
+    """Opens the current session's transaction as a write transaction.
+
+    MySQL takes row locks through SELECT ... FOR UPDATE, but SQLite has no
+    row locks, so there the database write lock is taken up front with
+    BEGIN IMMEDIATE. Concurrent writers then queue on the lock instead of
+    failing when they upgrade from a read.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite':
+        dbapi_connection = connection.connection.dbapi_connection
+        if not dbapi_connection.in_transaction:
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def bulk_insert(model, rows, batch_size=1000):
+    """Inserts rows into a model's table with one executemany per batch.
+
+    The rows are dicts of column values and may be any iterable, so large
+    imports can be streamed. Statements run in the current session's
+    transaction and the caller is responsible for committing.
+
+    Returns the number of rows inserted.
+    """
+    rows = iter(rows)
+    inserted = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return inserted
+        db.session.execute(model.__table__.insert(), batch)
+        inserted += len(batch)
 
 
 class User(db.Model):
@@ -52,23 +286,69 @@ class Listing(db.Model):
     address = db.Column(db.String(5000), nullable=False)
     date_created = db.Column(db.String(10), nullable=False)
     last_modified_date = db.Column(db.String(10), nullable=False)
-    booked_dates = relationship('Dates', back_populates='listing')
-    
+    # First window of free nights, half-open and open-ended if
+    # available_until is null, kept up to date as ranges are booked
+    # (see qbay.listing.Listing.find_min_booking_date)
+    next_available = db.Column(db.String(10), nullable=True)
+    available_until = db.Column(db.String(10), nullable=True)
+    booked_ranges = relationship('BookedRange', back_populates='listing')
+
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     owner = relationship('User', back_populates='listings')
     bookings = relationship('Booking', back_populates='listing')
     reviews = relationship('Review', back_populates='listing')
 
+    # Home feed keyset: newest first, ties broken by id
+    __table_args__ = (
+        db.Index('ix_listings_created_id', 'date_created', 'id'),
+        db.UniqueConstraint('title', name='uq_listings_title'),
+        db.Index('ix_listings_owner_id', 'owner_id'),
+        db.Index('ix_listings_price_id', 'price', 'id'),
+    )
+
     def __repr__(self) -> str:
         return f'<Listing {self.title}>'
 
 
-class Dates(db.Model):
-    __tablename__ = "dates"
+# Full-text index over listing titles, descriptions and addresses, see
+# qbay/search.py. SQLite keeps a separate FTS5 table that the app fills;
+# MySQL maintains a FULLTEXT index by itself.
+LISTINGS_FTS_SQLITE = ("CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts "
+                       "USING fts5(title, description, address)")
+LISTINGS_FTS_MYSQL = ("ALTER TABLE listings ADD FULLTEXT INDEX "
+                      "ft_listings_search (title, description, address)")
+event.listen(Listing.__table__, 'after_create',
+             DDL(LISTINGS_FTS_SQLITE).execute_if(dialect='sqlite'))
+event.listen(Listing.__table__, 'after_drop',
+             DDL("DROP TABLE IF EXISTS listings_fts").execute_if(
+                 dialect='sqlite'))
+event.listen(Listing.__table__, 'after_create',
+             DDL(LISTINGS_FTS_MYSQL).execute_if(dialect='mysql'))
+
+
+class BookedRange(db.Model):
+    """Half-open interval [start_date, end_date) of booked nights.
+
+    Ranges of a listing never overlap and adjacent ranges are merged on
+    insert, so the first range ending after a date is the only one that
+    can contain it.
+    """
+    __tablename__ = "booked_ranges"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'))
-    listing = relationship("Listing", back_populates='booked_dates')
-    date = db.Column(db.String(10), nullable=False)
+    listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'),
+                           nullable=False)
+    listing = relationship("Listing", back_populates='booked_ranges')
+    start_date = db.Column(db.String(10), nullable=False)
+    end_date = db.Column(db.String(10), nullable=False)  # exclusive
+
+    __table_args__ = (
+        db.Index('ix_booked_ranges_listing_end', 'listing_id', 'end_date'),
+        db.UniqueConstraint('listing_id', 'start_date',
+                            name='uq_booked_ranges_listing_start'),
+    )
+
+    def __repr__(self) -> str:
+        return f'<BookedRange {self.start_date} - {self.end_date}>'
 
 
 class Booking(db.Model):
@@ -85,10 +365,37 @@ class Booking(db.Model):
     start_date = db.Column(db.String(10), nullable=False)
     end_date = db.Column(db.String(10), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_bookings_buyer_id', 'buyer_id'),
+        db.Index('ix_bookings_listing_id', 'listing_id'),
+    )
+
     def __repr__(self) -> str:
         return f'<Booking {self.id}>'
 
 
+class LedgerEntry(db.Model):
+    """One movement of a user's balance, see qbay/ledger.py. Entries are
+    only ever appended, and a user's balance is the sum of their entries.
+    """
+    __tablename__ = 'balance_ledger'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                        nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)
+    booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id'),
+                           nullable=True)
+    created_at = db.Column(db.String(19), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_balance_ledger_user_id', 'user_id', 'id'),
+    )
+
+    def __repr__(self) -> str:
+        return f'<LedgerEntry {self.user_id} {self.delta:+}>'
+
+
 class Review(db.Model):
     __tablename__ = 'reviews'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -100,5 +407,9 @@ class Review(db.Model):
     listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'))
     listing = relationship('Listing', back_populates='reviews')
 
+    __table_args__ = (
+        db.Index('ix_reviews_listing_id', 'listing_id'),
+    )
+
     def __repr__(self) -> str:
         return f'<Review {self.id}>'
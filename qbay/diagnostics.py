@@ -0,0 +1,221 @@
+# diagnostics.py
+"""
+Query diagnostics, enabled with QBAY_DIAGNOSTICS (env diagnostics=1).
+
+Listens to the engine's cursor events and reports to the qbay.diagnostics
+logger:
+- slow statements, taking QBAY_SLOW_QUERY_MS or longer, with the line of
+  qbay code (or template) that ran them;
+- N+1 patterns: the same statement shape, the SQL with its literals and IN
+  lists collapsed, run QBAY_N_PLUS_ONE times or more in one request or
+  diagnostics.scope() block. These typically come from a relationship or
+  query property read once per row of an earlier result, such as
+  listing.owner in a loop. Each pattern is logged once per process, with
+  the line that ran it the QBAY_N_PLUS_ONE-th time.
+
+Findings are also kept on the app's Detector, so the test suite can fail
+on N+1 patterns it does not know about yet (see qbay_test/conftest.py).
+Statements the booking dispatcher runs on its own threads belong to no
+request, so only their duration is checked.
+"""
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from flask import request
+from sqlalchemy import event
+
+from qbay.database import db
+
+logger = logging.getLogger(__name__)
+
+_PACKAGE = os.path.dirname(os.path.abspath(__file__))
+_PREFIX = os.path.join(_PACKAGE, '')
+# Modules whose frames are hooks rather than the code running a statement
+_HOOKS = {os.path.join(_PACKAGE, name)
+          for name in ('diagnostics.py', 'metrics.py', 'profiler.py')}
+
+_SPACE = re.compile(r'\s+')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = r'\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*'
+_LIST = re.compile(rf'\((?:{_PLACEHOLDER},)+{_PLACEHOLDER}\)')
+
+# The Scope statements are counted in, per thread and across nested app
+# contexts
+_scope = contextvars.ContextVar('qbay_diagnostics_scope', default=None)
+
+
+@functools.lru_cache(maxsize=1024)
+def shape(statement: str):
+    """Returns a statement with its literals replaced by ? and its IN
+    lists of any length collapsed to (?)
+    """
+    statement = _SPACE.sub(' ', statement).strip()
+    return _LIST.sub('(?)', _LITERAL.sub('?', statement))
+
+
+def call_site():
+    """Returns where the qbay code running a statement is, as
+    "path:line in function", or "template:line" for a template
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        template = frame.f_globals.get('__jinja_template__')
+        if template is not None:
+            return (f"{template.name}:"
+                    f"{template.get_corresponding_lineno(frame.f_lineno)}")
+        if filename.startswith(_PREFIX) and filename not in _HOOKS:
+            path = os.path.relpath(filename, os.path.dirname(_PACKAGE))
+            return f"{path}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "unknown"
+
+
+class Finding:
+    """A slow statement or N+1 pattern found by a Detector.
+
+    params:
+    - kind: "slow" or "n+1" (str)
+    - scope: The endpoint or diagnostics.scope() name it was found in,
+      None outside of both (str)
+    - shape: The statement shape (str)
+    - site: Where the statement was run (str)
+    - count: Times it was run in the scope (int)
+    - milliseconds: How long the slowest run took (float)
+    """
+
+    def __init__(self, kind, scope, shape, site, count=1,
+                 milliseconds=0.0):
+        self.kind = kind
+        self.scope = scope
+        self.shape = shape
+        self.site = site
+        self.count = count
+        self.milliseconds = milliseconds
+
+    @property
+    def key(self):
+        return (self.kind, self.scope, self.shape)
+
+    def __repr__(self):
+        if self.kind == 'slow':
+            return (f"Slow statement ({self.milliseconds:.1f} ms) at "
+                    f"{self.site} in {self.scope}: {self.shape}")
+        return (f"N+1 pattern: {self.count} runs at {self.site} in "
+                f"{self.scope}: {self.shape}")
+
+
+class Scope:
+    """Statement shapes run in one request or diagnostics.scope() block"""
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}
+        self.sites = {}  # shape -> site of its QBAY_N_PLUS_ONE-th run
+
+
+class Detector:
+    """Checks the statements run on an engine.
+
+    params:
+    - slow_ms: Duration from which a statement is reported (float)
+    - repeats: Runs of one shape in a scope that make an N+1 pattern (int)
+    """
+
+    def __init__(self, slow_ms: float = 100, repeats: int = 10):
+        self.slow_ms = slow_ms
+        self.repeats = repeats
+        self.findings = {}  # key -> first Finding of each pattern
+        self._lock = threading.Lock()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        if context is not None:
+            context._qbay_diagnostics_started = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        started = getattr(context, '_qbay_diagnostics_started', None)
+        if started is None:
+            return
+        milliseconds = (time.perf_counter() - started) * 1000
+        scope = _scope.get()
+        if milliseconds >= self.slow_ms:
+            self.report(Finding('slow', scope and scope.name,
+                                shape(statement), call_site(),
+                                milliseconds=milliseconds))
+        if scope is not None:
+            key = shape(statement)
+            count = scope.counts[key] = scope.counts.get(key, 0) + 1
+            if count == self.repeats:
+                scope.sites[key] = call_site()
+
+    def finish(self, scope: Scope):
+        """Reports the N+1 patterns of a scope that has ended"""
+        for key, site in scope.sites.items():
+            self.report(Finding('n+1', scope.name, key, site,
+                                scope.counts[key]))
+
+    def report(self, finding: Finding):
+        with self._lock:
+            known = self.findings.get(finding.key)
+            if known is None:
+                self.findings[finding.key] = finding
+            elif finding.kind == 'slow':
+                known.count += 1
+                known.milliseconds = max(known.milliseconds,
+                                         finding.milliseconds)
+        # Slow statements are worth every line; a pattern once is enough
+        if known is None or finding.kind == 'slow':
+            logger.warning("%r", finding)
+
+
+@contextlib.contextmanager
+def scope(app, name: str):
+    """Checks the statements run in the block for N+1 patterns as one unit
+    of work, like a request; does nothing if diagnostics are disabled
+    """
+    detector = app.extensions.get('qbay_diagnostics')
+    if detector is None:
+        yield
+        return
+    token = _scope.set(Scope(name))
+    try:
+        yield
+    finally:
+        current = _scope.get()
+        _scope.reset(token)
+        detector.finish(current)
+
+
+def init_app(app):
+    """Checks the statements of the app if QBAY_DIAGNOSTICS is enabled"""
+    if not app.config['QBAY_DIAGNOSTICS']:
+        return
+    detector = app.extensions['qbay_diagnostics'] = Detector(
+        app.config['QBAY_SLOW_QUERY_MS'], app.config['QBAY_N_PLUS_ONE'])
+
+    def start_request():
+        request.environ['qbay.diagnostics'] = _scope.set(
+            Scope(request.endpoint))
+
+    def finish_request(_):
+        token = request.environ.pop('qbay.diagnostics', None)
+        if token is not None:
+            current = _scope.get()
+            _scope.reset(token)
+            detector.finish(current)
+
+    app.before_request(start_request)
+    app.teardown_request(finish_request)
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute',
+                     detector.before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute',
+                     detector.after_cursor_execute)
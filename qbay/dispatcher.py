@@ -0,0 +1,152 @@
+# dispatcher.py
+"""
+In-process booking dispatcher.
+
+Bookings are queued onto a fixed pool of worker threads, sharded by
+listing id. One worker handles every booking of a listing, one at a time
+and in arrival order, so bookings of a popular listing no longer queue on
+its database row lock from many request threads, while different listings
+are booked in parallel.
+
+Each process has its own dispatcher, so with several server processes
+bookings of one listing can still meet in the database; the locking in
+Booking.book_listing keeps them correct.
+"""
+import logging
+import queue
+import threading
+import uuid
+
+from qbay import metrics
+from qbay.booking import Booking
+from qbay.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class Ticket:
+    """The progress of one queued booking.
+
+    status is "queued", then "running", then "booked" or "failed"; message
+    holds the reason a booking failed.
+    """
+
+    def __init__(self, buyer_id, owner_id, listing_id, start_date,
+                 end_date):
+        self.id = uuid.uuid4().hex
+        self.buyer_id = buyer_id
+        self.owner_id = owner_id
+        self.listing_id = listing_id
+        self.start_date = start_date
+        self.end_date = end_date
+        self.status = 'queued'
+        self.message = ''
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits until the booking is finished; returns whether it is"""
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {'id': self.id, 'status': self.status,
+                'message': self.message, 'listing_id': self.listing_id,
+                'start_date': self.start_date, 'end_date': self.end_date}
+
+
+class BookingDispatcher:
+    """Runs Booking.book_listing on worker threads, one queue per worker.
+
+    params:
+    - app: The Flask app bookings run in (Flask)
+    - workers: Number of worker threads (int)
+    - max_tickets: Finished tickets kept for status polling (int)
+    """
+
+    def __init__(self, app, workers=4, max_tickets=10000):
+        self.app = app
+        self.tickets = LRUCache(maxsize=max_tickets, ttl=3600)
+        self._queues = [queue.Queue() for _ in range(max(workers, 1))]
+        self._threads = [
+            threading.Thread(target=self._work, args=(q,), daemon=True,
+                             name=f'qbay-booking-{i}')
+            for i, q in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, buyer_id, owner_id, listing_id, start_date, end_date):
+        """Queues a booking behind earlier bookings of the same listing.
+
+        Returns:
+            Ticket: follows the booking until it is finished
+        """
+        ticket = Ticket(buyer_id, owner_id, listing_id, start_date,
+                        end_date)
+        self.tickets.put(ticket.id, ticket)
+        shard = int(listing_id) % len(self._queues)
+        self._queues[shard].put(ticket)
+        return ticket
+
+    def status(self, ticket_id):
+        """Returns the ticket with the given id, or None if it is unknown
+        or has expired.
+        """
+        return self.tickets.get(ticket_id)
+
+    def pending(self):
+        """Returns the number of bookings waiting in each worker's queue"""
+        return [q.qsize() for q in self._queues]
+
+    def shutdown(self):
+        """Finishes every queued booking, then stops the workers"""
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self, tickets):
+        for ticket in iter(tickets.get, None):
+            ticket.status = 'running'
+            try:
+                with self.app.app_context():
+                    Booking.book_listing(ticket.buyer_id, ticket.owner_id,
+                                         ticket.listing_id,
+                                         ticket.start_date, ticket.end_date)
+                ticket.status = 'booked'
+            except ValueError as e:
+                ticket.status = 'failed'
+                ticket.message = str(e)
+            except Exception:
+                logger.exception("Booking %s failed", ticket.id)
+                ticket.status = 'failed'
+                ticket.message = "Booking failed, please try again"
+            finally:
+                metrics.record_booking(self.app, ticket.status,
+                                       ticket.message)
+                ticket._done.set()
+
+
+_lock = threading.Lock()
+
+
+def get_dispatcher(app):
+    """Returns the app's booking dispatcher, starting it on first use"""
+    dispatcher = app.extensions.get('qbay_dispatcher')
+    if dispatcher is None:
+        with _lock:
+            dispatcher = app.extensions.get('qbay_dispatcher')
+            if dispatcher is None:
+                dispatcher = BookingDispatcher(
+                    app, app.config['QBAY_BOOKING_WORKERS'])
+                app.extensions['qbay_dispatcher'] = dispatcher
+    return dispatcher
+
+
+def shutdown(app):
+    """Drains and stops the app's booking dispatcher, if it was started"""
+    dispatcher = app.extensions.pop('qbay_dispatcher', None)
+    if dispatcher is not None:
+        dispatcher.shutdown()
@@ -0,0 +1,313 @@
+# importer.py
+"""
+Bulk import of users, listings and bookings, used by `python -m qbay
+import`.
+
+Records are streamed from CSV (with a header row) or JSON Lines files and
+handled in chunks. Every record of a chunk is checked with the same valid_*
+rules as User.register and Listing.create_listing, uniqueness and
+references are checked with one query per chunk, and the accepted records
+are written with bulk inserts in a single transaction per chunk. Invalid
+records are reported with their line number and skipped.
+
+Fields:
+- users: username, email, password, [balance (dollars), postal_code,
+  billing_address]
+- listings: title, description, price (dollars), owner_email or owner_id,
+  [address]
+- bookings: buyer_email or buyer_id, listing_title or listing_id,
+  start_date, end_date (YYYY-MM-DD, end exclusive). Imported bookings are
+  taken as already paid, so no balance changes.
+"""
+import csv
+import errno
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+
+from qbay import database, ledger, search
+from qbay.database import db
+from qbay.listing import Listing, feed_cache
+from qbay.user import User
+
+KINDS = ('users', 'listings', 'bookings')
+
+
+class ImportReport:
+    """Counts of the records an import accepted and rejected.
+
+    params:
+    - kind: The kind of records imported (str)
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.imported = 0
+        self.errors = []  # (line, message)
+        self.seconds = 0.0
+
+    @property
+    def records(self):
+        return self.imported + len(self.errors)
+
+    @property
+    def rate(self):
+        """Records handled per second"""
+        return self.records / self.seconds if self.seconds else 0.0
+
+    def error(self, line, message):
+        self.errors.append((line, message))
+
+    def summary(self):
+        return (f"Imported {self.imported} of {self.records} {self.kind} in "
+                f"{self.seconds:.2f} s ({self.rate:.0f} records/s), "
+                f"{len(self.errors)} rejected")
+
+
+def read_records(path, format=None):
+    """Yields (line number, record) for each record of a CSV or JSON Lines
+    file. The format defaults to the file extension. A JSON line that does
+    not hold an object is yielded as a None record.
+    """
+    format = format or ('csv' if path.lower().endswith('.csv')
+                        else 'jsonl')
+    with open(path, newline='', encoding='utf-8') as file:
+        if format == 'csv':
+            reader = csv.DictReader(file)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for line, text in enumerate(file, 1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+            except ValueError:
+                record = None
+            yield line, record if isinstance(record, dict) else None
+
+
+def _field(record, name):
+    """Returns a field as a stripped string, or None if it is missing"""
+    value = record.get(name)
+    if value is None or str(value).strip() == '':
+        return None
+    return str(value).strip()
+
+
+def _lookup(column, values, *criteria):
+    """Returns {value: id} for the rows whose column is one of values"""
+    model = column.class_
+    if not values:
+        return {}
+    return dict(db.session.query(column, model.id).filter(
+        column.in_(list(values)), *criteria))
+
+
+def _ids(values):
+    return [int(value) for value in values if value.isdigit()]
+
+
+def _import_users(chunk, report):
+    accepted = {}
+    for line, record in chunk:
+        username = _field(record, 'username') or ''
+        email = _field(record, 'email') or ''
+        password = record.get('password') or ''
+        if not User.valid_email(email):
+            report.error(line, f"Invalid email: {email}")
+        elif not User.valid_password(password):
+            report.error(line, "Invalid password")
+        elif not User.valid_username(username):
+            report.error(line, f"Invalid username: {username}")
+        elif email in accepted:
+            report.error(line, f"Email already exists: {email}")
+        else:
+            try:
+                balance = int(_field(record, 'balance') or 100)
+            except ValueError:
+                report.error(line, f"Invalid balance: {record['balance']}")
+                continue
+            accepted[email] = line, {
+                'username': username, 'email': email, 'password': password,
+                'balance': balance * 100,
+                'postal_code': _field(record, 'postal_code') or '',
+                'billing_address': _field(record, 'billing_address') or ''}
+
+    existing = _lookup(database.User.email, accepted)
+    rows = []
+    for email, (line, row) in accepted.items():
+        if email in existing:
+            report.error(line, f"Email already exists: {email}")
+        else:
+            rows.append(row)
+    inserted = database.bulk_insert(database.User, rows)
+    # Found by email rather than as the ids above the previous maximum,
+    # which may include users registered concurrently with their own
+    # opening entries
+    ledger.open_accounts(_lookup(database.User.email,
+                                 [row['email'] for row in rows]).values())
+    return inserted
+
+
+def _import_listings(chunk, report):
+    today = datetime.now().strftime('%Y-%m-%d')
+    owner_ids = {_field(record, 'owner_id') for _, record in chunk} - {None}
+    owner_emails = {_field(record, 'owner_email')
+                    for _, record in chunk} - {None}
+    sellers = _lookup(database.User.email, owner_emails,
+                      database.User.email != "")
+    sellers.update((str(id), id) for id in _lookup(
+        database.User.id, _ids(owner_ids), database.User.email != ""))
+    taken = set(_lookup(database.Listing.title,
+                        {record.get('title') for _, record in chunk}
+                        - {None}))
+
+    rows = []
+    for line, record in chunk:
+        title = record.get('title') or ''
+        description = record.get('description') or ''
+        owner = (_field(record, 'owner_id') or
+                 _field(record, 'owner_email'))
+        try:
+            price = float(_field(record, 'price') or 0)
+        except ValueError:
+            price = 0
+        if not Listing.valid_title_format(title):
+            report.error(line, f"Invalid Title: {title}")
+        elif title in taken:
+            report.error(line, f"Title already exists: {title}")
+        elif owner not in sellers:
+            report.error(line, f"Invalid Seller: {owner}")
+        elif not Listing.valid_price(price, 0):
+            report.error(line, f"Invalid Price: {record.get('price')}")
+        elif not Listing.valid_description(description, title):
+            report.error(line, f"Invalid Description: {description}")
+        else:
+            taken.add(title)
+            rows.append({
+                'title': title, 'description': description,
+                'price': round(price * 100), 'owner_id': sellers[owner],
+                'address': _field(record, 'address') or '',
+                'date_created': today, 'last_modified_date': today})
+
+    inserted = database.bulk_insert(database.Listing, rows)
+    # Found by title, as listings created concurrently index themselves
+    search.index_listings(_lookup(database.Listing.title,
+                                  [row['title'] for row in rows]).values())
+    feed_cache.clear(counters=False)
+    for row in rows:
+        Listing.remember_title(row['title'])
+    return inserted
+
+
+def _import_bookings(chunk, report):
+    buyer_ids = {_field(record, 'buyer_id') for _, record in chunk} - {None}
+    buyer_emails = {_field(record, 'buyer_email')
+                    for _, record in chunk} - {None}
+    buyers = _lookup(database.User.email, buyer_emails)
+    buyers.update((str(id), id) for id in _lookup(
+        database.User.id, _ids(buyer_ids)))
+
+    listing_ids = {_field(record, 'listing_id')
+                   for _, record in chunk} - {None}
+    titles = {record.get('listing_title') for _, record in chunk} - {None}
+    by_title = _lookup(database.Listing.title, titles)
+    by_id = {str(id): id
+             for id in _lookup(database.Listing.id, _ids(listing_ids))}
+    found = {*by_title.values(), *by_id.values()}
+    owners = dict(db.session.query(
+        database.Listing.id, database.Listing.owner_id).filter(
+        database.Listing.id.in_(list(found))))
+
+    # Booked ranges of the chunk's listings, grown as records are accepted
+    booked = {id: [] for id in owners}
+    for booked_range in database.BookedRange.query.filter(
+            database.BookedRange.listing_id.in_(list(owners))):
+        booked[booked_range.listing_id].append(
+            (booked_range.start_date, booked_range.end_date))
+
+    bookings, ranges = [], []
+    for line, record in chunk:
+        buyer = _field(record, 'buyer_id') or _field(record, 'buyer_email')
+        if _field(record, 'listing_id'):
+            listing, listings = _field(record, 'listing_id'), by_id
+        else:
+            listing, listings = record.get('listing_title'), by_title
+        try:
+            start, end = (datetime.strptime(
+                _field(record, key) or '', '%Y-%m-%d').strftime('%Y-%m-%d')
+                for key in ('start_date', 'end_date'))
+        except ValueError:
+            report.error(line, "Dates must be given as YYYY-MM-DD")
+            continue
+        if buyer not in buyers:
+            report.error(line, f"Invalid Buyer: {buyer}")
+        elif listing not in listings:
+            report.error(line, f"Invalid Listing: {listing}")
+        elif buyers[buyer] == owners[listings[listing]]:
+            report.error(line, "Owner and buyer are the same!")
+        elif start >= end:
+            report.error(line, "Start date is same or after end date!")
+        elif any(s < end and e > start
+                 for s, e in booked[listings[listing]]):
+            report.error(line, "Given dates overlap with existing bookings!")
+        else:
+            listing_id = listings[listing]
+            booked[listing_id].append((start, end))
+            bookings.append({'buyer_id': buyers[buyer],
+                             'owner_id': owners[listing_id],
+                             'listing_id': listing_id,
+                             'start_date': start, 'end_date': end})
+            ranges.append({'listing_id': listing_id, 'start_date': start,
+                           'end_date': end})
+
+    database.bulk_insert(database.BookedRange, ranges)
+    Listing.refresh_free_windows({row['listing_id'] for row in ranges})
+    return database.bulk_insert(database.Booking, bookings)
+
+
+_IMPORTERS = {'users': _import_users, 'listings': _import_listings,
+              'bookings': _import_bookings}
+
+
+def import_records(kind, records, batch_size=1000):
+    """Imports (line number, record) pairs of the given kind in chunks of
+    batch_size records, each in its own transaction.
+
+    Returns an ImportReport.
+    """
+    importer = _IMPORTERS[kind]
+    report = ImportReport(kind)
+    started = time.perf_counter()
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        chunk = []
+        for line, record in batch:
+            if record is None:
+                report.error(line, "Not a record")
+            else:
+                chunk.append((line, record))
+        try:
+            database.begin_write()
+            report.imported += importer(chunk, report)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    report.seconds = time.perf_counter() - started
+    report.errors.sort()
+    return report
+
+
+def import_file(kind, path, format=None, batch_size=1000):
+    """Imports the records of a CSV or JSON Lines file; see import_records
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(errno.ENOENT, "No such file", path)
+    return import_records(kind, read_records(path, format), batch_size)
@@ -0,0 +1,129 @@
+# ledger.py
+"""
+Append-only ledger of balance movements.
+
+users.balance is a materialized snapshot of the sum of a user's ledger
+entries, so reading a balance stays a single-row lookup. Every movement
+appends a balance_ledger row and applies an atomic
+`UPDATE users SET balance = balance + :delta` in the same transaction, so
+concurrent movements never overwrite each other, and reconcile() can
+check every snapshot against the ledger. Amounts are integer cents, as
+users.balance is stored.
+
+Nothing here commits; movements become visible with the caller's
+transaction.
+"""
+from datetime import datetime
+from sqlalchemy import func, literal, select
+
+from qbay import database
+from qbay.database import db
+
+# Reasons recorded with ledger entries
+OPENING = 'opening'
+BOOKING = 'booking'
+ADJUSTMENT = 'adjustment'
+
+
+def _now():
+    return datetime.now().isoformat(sep=' ', timespec='seconds')
+
+
+def post(user_id, delta, reason, booking_id=None, minimum=None):
+    """Stages a movement of delta cents on a user's balance.
+
+    With minimum, the movement is only applied if the balance stays at or
+    above it, checked in the same statement that applies it.
+
+    Returns:
+        True if the movement was applied, False if the user does not
+        exist or the balance would drop below minimum
+    """
+    # A float would be rounded separately by the balance update and the
+    # ledger insert on some databases, and reconcile would report drift
+    assert isinstance(delta, int), f"Amounts are integer cents: {delta!r}"
+    users = database.User.__table__
+    statement = users.update().where(users.c.id == user_id).values(
+        balance=users.c.balance + delta)
+    if minimum is not None:
+        statement = statement.where(users.c.balance + delta >= minimum)
+    if db.session.execute(statement).rowcount != 1:
+        return False
+    db.session.execute(database.LedgerEntry.__table__.insert(), {
+        'user_id': user_id, 'delta': delta, 'reason': reason,
+        'booking_id': booking_id, 'created_at': _now()})
+    return True
+
+
+def transfer(from_id, to_id, amount, reason, booking_id=None):
+    """Stages moving amount cents from one user's balance to another's, without
+    letting the payer's balance go negative. Rows are updated in id order
+    so concurrent transfers cannot deadlock.
+
+    Returns:
+        True if the transfer was staged, False if the payer cannot afford
+        it, in which case the caller must roll back
+    """
+    for user_id in sorted((from_id, to_id)):
+        if user_id == from_id:
+            if not post(from_id, -amount, reason, booking_id, minimum=0):
+                return False
+        elif not post(to_id, amount, reason, booking_id):
+            return False
+    return True
+
+
+def set_balance(user_id, value, reason=ADJUSTMENT):
+    """Stages setting a user's balance to value cents, recorded as the
+    difference from the current balance. The user's row is locked first.
+    """
+    users = database.User.__table__
+    current = db.session.execute(
+        select(users.c.balance).where(users.c.id == user_id)
+        .with_for_update()).scalar()
+    if current is not None and value != current:
+        post(user_id, value - current, reason)
+
+
+def open_account(user_id, balance):
+    """Stages the opening entry of a new user created with balance cents
+    """
+    db.session.execute(database.LedgerEntry.__table__.insert(), {
+        'user_id': user_id, 'delta': balance, 'reason': OPENING,
+        'created_at': _now()})
+
+
+def open_accounts(user_ids):
+    """Stages an opening entry for the balance of each user with one of
+    the given ids, for users written with bulk inserts.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    users = database.User.__table__
+    ledger = database.LedgerEntry.__table__
+    db.session.execute(ledger.insert().from_select(
+        ['user_id', 'delta', 'reason', 'created_at'],
+        select(users.c.id, users.c.balance, literal(OPENING),
+               literal(_now())).where(
+            users.c.id.in_(user_ids))))
+
+
+def reconcile():
+    """Checks every user's balance against the sum of their ledger entries
+    with one aggregate query.
+
+    Returns:
+        (users checked, [(user_id, balance, ledger total)] for every user
+        whose balance does not match)
+    """
+    ledger = database.LedgerEntry
+    totals = select(ledger.user_id, func.sum(ledger.delta).label(
+        'total')).group_by(ledger.user_id).subquery()
+    total = func.coalesce(totals.c.total, 0)
+    mismatches = db.session.query(
+        database.User.id, database.User.balance, total).outerjoin(
+        totals, totals.c.user_id == database.User.id).filter(
+        database.User.balance != total).order_by(database.User.id).all()
+    checked = db.session.query(func.count(database.User.id)).scalar()
+    return checked, [tuple(row) for row in mismatches]
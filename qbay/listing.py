@@ -1,14 +1,37 @@
 # listing.py
 from enum import Enum, unique
-from typing import List
+from typing import List, Tuple
 from multiprocessing.sharedctypes import Value
 from qbay.user import User
 from qbay.review import Review
 from datetime import datetime, timedelta
+import base64
+import binascii
 import re
+import threading
 
-from qbay import database
+from qbay import database, search
+from qbay.cache import BloomFilter, LRUCache
 from qbay.database import db
+from sqlalchemy import and_, exc, exists, func, or_, update
+from sqlalchemy.orm import joinedload
+
+# Home feed pages as (listing ids, prev cursor, next cursor), keyed by
+# (size, after, before), and rendered listing cards keyed by listing id.
+# Entries are dropped whenever this process changes what they show; the
+# TTLs bound how stale an entry changed by another process can get.
+feed_cache = LRUCache(maxsize=256, ttl=10)
+card_cache = LRUCache(maxsize=4096, ttl=60)
+
+# Titles taken in the database, loaded on first use and added to whenever
+# this process creates or renames a listing. A title missing from it is
+# free without asking the database; one taken by another process since the
+# filter was loaded is still rejected by the unique index on insert.
+_title_filter = None
+_title_filter_lock = threading.Lock()
+
+_TITLE_PATTERN = re.compile(
+    r'(^([A-Za-z0-9]([A-Za-z0-9]| ){,78}[A-Za-z0-9])$)|[A-Za-z0-9]')
 
 
 class Listing:
@@ -154,14 +177,30 @@ class Listing:
         self._reviews = comments
 
     @property
-    def booked_dates(self) -> 'List[str]':
-        """Fetches list of booked dates"""
+    def booked_ranges(self) -> 'List[Tuple[str, str]]':
+        """Fetches booked nights as sorted, half-open (start, end) ranges"""
         if self.database_obj:
-            result = database.Dates.query.filter_by(listing_id=self.id).all()
-            booked_dates = [d.date for d in result]
-            return booked_dates
+            result = database.BookedRange.query.filter_by(
+                listing_id=self.id).order_by(
+                database.BookedRange.start_date).all()
+            return [(r.start_date, r.end_date) for r in result]
         return None
 
+    @property
+    def booked_dates(self) -> 'List[str]':
+        """Fetches list of booked dates, expanded from the booked ranges"""
+        ranges = self.booked_ranges
+        if ranges is None:
+            return None
+        booked_dates = []
+        for start, end in ranges:
+            day = datetime.strptime(start, '%Y-%m-%d')
+            last = datetime.strptime(end, '%Y-%m-%d')
+            while day < last:
+                booked_dates.append(day.strftime('%Y-%m-%d'))
+                day += timedelta(days=1)
+        return booked_dates
+
     def add_review(self, review: 'Review'):
         """Add reviews to listing"""
         self._reviews.append(review)
@@ -174,13 +213,23 @@ class Listing:
                                    owner_id=self.seller.id,
                                    address=self.address,
                                    date_created=self.created_date,
-                                   last_modified_date=self.modified_date)
-        with database.app.app_context():
+                                   last_modified_date=self.modified_date,
+                                   next_available=self.created_date)
+        with database.app_context():
             db.session.add(listing)
+            try:
+                db.session.flush()
+            except exc.IntegrityError:
+                db.session.rollback()
+                raise ValueError(f"Invalid Title: {self.title}")
+            search.index_listing(listing)
             db.session.commit()
             self._database_obj = listing
             self._modified_date = listing.last_modified_date
             self._id = listing.id
+        Listing.remember_title(listing.title)
+        # A new listing shifts every feed page
+        feed_cache.clear(counters=False)
 
     @staticmethod
     def create_listing(title, description, price, owner, address=""):
@@ -211,14 +260,57 @@ class Listing:
     @staticmethod
     def valid_title(title):
         """Determine if a given title is valid """
-        regex = re.compile(
-            r'(^([A-Za-z0-9]([A-Za-z0-9]| ){,78}[A-Za-z0-9])$)|[A-Za-z0-9]')
-        if re.fullmatch(regex, title):
-            with database.app.app_context():
-                exists = database.Listing.query.filter_by(title=title).all()
-            return not len(exists)
+        if Listing.valid_title_format(title):
+            return not Listing.title_taken(title)
         return False
 
+    @staticmethod
+    def valid_title_format(title):
+        """Determine if a given title is well formed, whether or not it is
+        already taken
+        """
+        return bool(_TITLE_PATTERN.fullmatch(title))
+
+    @staticmethod
+    def title_taken(title, exact=False):
+        """Determine if a listing already has the given title. Titles the
+        title filter has never seen are answered without a query, unless
+        exact is set: titles other processes took since the filter was
+        loaded are not in it.
+        """
+        if not exact and title not in Listing.title_filter():
+            return False
+        with database.app_context():
+            return db.session.query(exists().where(
+                database.Listing.title == title)).scalar()
+
+    @staticmethod
+    def title_filter():
+        """Returns the filter of taken titles, loading it from the database
+        on first use and again once it outgrows its size.
+        """
+        global _title_filter
+        titles = _title_filter
+        if titles is None or titles.full:
+            with _title_filter_lock:
+                if _title_filter is None or _title_filter.full:
+                    with database.app_context():
+                        count = db.session.query(
+                            func.count(database.Listing.id)).scalar()
+                        titles = BloomFilter(max(2 * count, 100000))
+                        for title, in db.session.query(
+                                database.Listing.title).yield_per(10000):
+                            titles.add(title)
+                    _title_filter = titles
+                titles = _title_filter
+        return titles
+
+    @staticmethod
+    def remember_title(title):
+        """Adds a title this process just wrote to the title filter"""
+        if _title_filter is not None:
+            _title_filter.add(title)
+
     @staticmethod
     def valid_description(description, title):
         """Determine if a given description is valid"""
@@ -241,7 +333,7 @@ class Listing:
     def valid_seller(owner):
         """Determine if a given owner is valid"""
         if (owner.id):
-            with database.app.app_context():
+            with database.app_context():
                 user = database.User.query.get(owner.id)
                 return ((user is not None) and (user.email != ""))
         return False
@@ -251,8 +343,15 @@ class Listing:
         database.
         """
         self.title = title
-        self.database_obj.title = title
-        db.session.commit()
+        try:
+            self.database_obj.title = title
+            search.index_listing(self.database_obj)
+            db.session.commit()
+        except exc.IntegrityError:
+            db.session.rollback()
+            raise ValueError(f"Invalid Title: {title}")
+        Listing.remember_title(title)
+        Listing.invalidate_cache(self.id)
 
     def update_description(self, description):
         """Updates the listing description and pushes changes to the 
@@ -260,7 +359,9 @@ class Listing:
         """
         self.description = description
         self.database_obj.description = description
+        search.index_listing(self.database_obj)
         db.session.commit()
+        Listing.invalidate_cache(self.id)
 
     def update_price(self, price):
         """ Updates the listing price and pushes changes to the 
@@ -269,14 +370,24 @@ class Listing:
         self.price = price
         self.database_obj.price = price * 100
         db.session.commit()
+        Listing.invalidate_cache(self.id)
         
     def update_address(self, address):
         self.address = address
         self.database_obj.address = address
+        search.index_listing(self.database_obj)
         db.session.commit()
+        Listing.invalidate_cache(self.id)
 
     @staticmethod
-    def query_listing(id):
+    def invalidate_cache(*ids):
+        """ Drops the rendered cards of the listings with the given ids """
+        for id in ids:
+            if id is not None:
+                card_cache.pop(int(id))
+
+    @staticmethod
+    def query_listing(id, for_update=False):
         """ Returns a Listing object for interacting with the database
         in a safe manner. It will initialize a new User object that
         is tethered to the corresponding database object
@@ -284,54 +395,392 @@ class Listing:
         Args:
             id (int): integer denoting the unique identifier of the object
             to be queried for
+            for_update (bool): lock the listing's row until the current
+            transaction ends and reload it from the database
 
         Returns:
             Listing: a listing object that is tethered to the corresponding
             database object with the given id
         """
-        database_listing = database.Listing.query.get(int(id))
+        if for_update:
+            database_listing = database.Listing.query.filter_by(
+                id=int(id)).with_for_update().populate_existing().first()
+        else:
+            database_listing = database.Listing.query.get(int(id))
         if database_listing:
             listing = Listing()
             listing._database_obj = database_listing
             return listing
         return None
 
+    def overlapping_ranges(self, start: str, end: str):
+        """ Returns the booked (start, end) ranges that overlap the
+        half-open range [start, end). Dates are ISO formatted strings.
+        """
+        return [(r.start_date, r.end_date)
+                for r in self.overlapping_range_rows(start, end)]
+
+    def overlapping_range_rows(self, start: str, end: str):
+        """ Returns the BookedRange rows overlapping [start, end) """
+        return database.BookedRange.query.filter(
+            database.BookedRange.listing_id == self.id,
+            database.BookedRange.start_date < end,
+            database.BookedRange.end_date > start).order_by(
+            database.BookedRange.start_date).all()
+
+    def is_available(self, start: str, end: str):
+        """ Checks if no night in [start, end) is booked.
+
+        Booked ranges never overlap, so only the first range ending after
+        start can collide; this is a single index probe.
+        """
+        first = database.BookedRange.query.filter(
+            database.BookedRange.listing_id == self.id,
+            database.BookedRange.end_date > start).order_by(
+            database.BookedRange.end_date).first()
+        return first is None or first.start_date >= end
+
+    def add_booked_range(self, start: str, end: str):
+        """ Marks the nights in [start, end) as booked and commits. """
+        with database.app_context():
+            self.claim_range(start, end)
+            db.session.commit()
+
+    def claim_range(self, start: str, end: str):
+        """ Stages the nights in [start, end) as booked in the current
+        session without committing, merging the range with any booked
+        range that ends on start or begins on end.
+        """
+        if not self._merge_adjacent(start, end):
+            db.session.add(database.BookedRange(listing_id=self.id,
+                                                start_date=start,
+                                                end_date=end))
+        self._claim_window(start, end)
+
+    def release_range(self, start: str, end: str):
+        """ Stages the nights in [start, end) as free again in the current
+        session without committing, trimming or splitting the booked
+        ranges that cover them. The inverse of claim_range.
+        """
+        for booked in self.overlapping_range_rows(start, end):
+            if booked.start_date < start and booked.end_date > end:
+                db.session.add(database.BookedRange(
+                    listing_id=self.id, start_date=end,
+                    end_date=booked.end_date))
+                booked.end_date = start
+            elif booked.start_date < start:
+                booked.end_date = start
+            elif booked.end_date > end:
+                booked.start_date = end
+            else:
+                db.session.delete(booked)
+        # Freed nights can join the first free window to its neighbours
+        self._store_window(self._free_window_from(Listing._today()))
+
+    def _claim_window(self, start: str, end: str):
+        """ Moves the listing's first free window out of the newly booked
+        [start, end), querying the booked ranges only when the window is
+        used up or was never stored.
+        """
+        listing = self._current_row()
+        first, until = listing.next_available, listing.available_until
+        if first is None or (until is not None and until <= Listing._today()):
+            # Unknown or in the past; a write is a good time to refresh it
+            self._store_window(self._free_window_from(Listing._today()))
+        elif end <= first or (until is not None and start >= until):
+            pass
+        elif start > first:
+            listing.available_until = start
+        elif until is None or end < until:
+            listing.next_available = end
+        else:
+            self._store_window(self._free_window_from(end))
+
+    def _store_window(self, window: 'Tuple[str, str]'):
+        listing = self._current_row()
+        listing.next_available, listing.available_until = window
+
+    def _current_row(self) -> database.Listing:
+        """ Returns the current session's row of the listing, without a
+        query once loaded. database_obj may have been loaded in an app
+        context that has since ended, and not show later bookings.
+        """
+        return db.session.get(database.Listing, self.id)
+
+    def _free_window_from(self, day: str):
+        """ Finds the first free window on or after day from the booked
+        ranges """
+        ranges = database.BookedRange.query.filter(
+            database.BookedRange.listing_id == self.id,
+            database.BookedRange.end_date > day).order_by(
+            database.BookedRange.start_date)
+        return Listing.free_window(
+            ((r.start_date, r.end_date) for r in ranges), day)
+
+    @staticmethod
+    def free_window(ranges, day: str):
+        """ Returns the first window of free nights on or after day as a
+        half-open (start, end) range, end being None if no night after
+        start is booked.
+
+        Args:
+            ranges: booked (start, end) ranges, sorted by start
+            day (str): ISO formatted date to search from
+        """
+        for start, end in ranges:
+            if end <= day:
+                continue
+            if start > day:
+                return day, start
+            day = max(day, end)
+        return day, None
+
+    @staticmethod
+    def refresh_free_windows(ids=None):
+        """ Recomputes the stored first free window of the listings with
+        the given ids, or of every listing, from their booked ranges. For
+        ranges written in bulk; stages the updates without committing.
+        """
+        today = Listing._today()
+        ranges = database.BookedRange.query.filter(
+            database.BookedRange.end_date > today)
+        listings = db.session.query(database.Listing.id)
+        if ids is not None:
+            ids = list(ids)
+            ranges = ranges.filter(database.BookedRange.listing_id.in_(ids))
+            listings = listings.filter(database.Listing.id.in_(ids))
+        booked = {id: [] for id, in listings}
+        for r in ranges.order_by(database.BookedRange.start_date):
+            booked[r.listing_id].append((r.start_date, r.end_date))
+        rows = [dict(zip(('id', 'next_available', 'available_until'),
+                         (id, *Listing.free_window(booked[id], today))))
+                for id in booked]
+        if rows:
+            db.session.execute(update(database.Listing), rows)
+
+    def _merge_adjacent(self, start: str, end: str):
+        """ Grows the booked ranges touching [start, end) to cover it.
+        Returns False if no booked range touches it.
+        """
+        before = database.BookedRange.query.filter_by(
+            listing_id=self.id, end_date=start).first()
+        after = database.BookedRange.query.filter_by(
+            listing_id=self.id, start_date=end).first()
+        if before and after:
+            before.end_date = after.end_date
+            db.session.delete(after)
+        elif before:
+            before.end_date = end
+        elif after:
+            after.start_date = start
+        else:
+            return False
+        return True
+
+    @staticmethod
+    def feed_page(size: int = 20, after: str = None, before: str = None):
+        """ Fetches one page of the listing feed, newest first, using
+        keyset pagination on (date_created, id) so every page costs the
+        same index range scan no matter how deep it is.
+
+        params:
+        - size: Number of listings per page (int)
+        - after: Cursor of the last listing on the current page, to page
+          forwards (str)
+        - before: Cursor of the first listing on the current page, to page
+          backwards (str)
+
+        Returns:
+            (listings, prev_cursor, next_cursor); a cursor is None when
+            there is no page in that direction
+        """
+        created = database.Listing.date_created
+        listing_id = database.Listing.id
+        query = database.Listing.query.options(
+            joinedload(database.Listing.owner))
+        key = Listing._decode_cursor(before or after)
+        backwards = key is not None and before is not None
+
+        if key and backwards:
+            query = query.filter(or_(
+                created > key[0], and_(created == key[0],
+                                       listing_id > key[1])))
+            query = query.order_by(created.asc(), listing_id.asc())
+        else:
+            if key:
+                query = query.filter(or_(
+                    created < key[0], and_(created == key[0],
+                                           listing_id < key[1])))
+            query = query.order_by(created.desc(), listing_id.desc())
+
+        # Fetch one extra row to learn whether another page exists
+        listings = query.limit(size + 1).all()
+        more = len(listings) > size
+        listings = listings[:size]
+        if backwards:
+            listings.reverse()
+        if not listings:
+            return listings, None, None
+
+        has_prev = more if backwards else key is not None
+        has_next = True if backwards else more
+        prev_cursor = Listing._encode_cursor(listings[0]) if has_prev \
+            else None
+        next_cursor = Listing._encode_cursor(listings[-1]) if has_next \
+            else None
+        return listings, prev_cursor, next_cursor
+
+    @staticmethod
+    def search(query: str, page: int = 1, size: int = 20):
+        """ Full-text search over listing titles, descriptions and
+        addresses, best match first.
+
+        params:
+        - query: Words to search for, each matched as a prefix (str)
+        - page: 1-based page number (int)
+        - size: Number of listings per page (int)
+
+        Returns:
+            (listings, has_next) for the requested page; pages past
+            search.MAX_RESULTS are empty
+        """
+        offset = (page - 1) * size
+        limit = min(size + 1, search.MAX_RESULTS - offset)
+        if page < 1 or limit <= 0:
+            return [], False
+        ids = search.search_ids(query, limit, offset)
+        rows = database.Listing.query.options(
+            joinedload(database.Listing.owner)).filter(
+            database.Listing.id.in_(ids[:size])).all() if ids else []
+        by_id = {row.id: row for row in rows}
+        listings = [by_id[i] for i in ids[:size] if i in by_id]
+        return listings, len(ids) > size
+
+    @staticmethod
+    def available(start: str, end: str, min_price: float = None,
+                  max_price: float = None, sort: str = "price",
+                  page: int = 1, size: int = 20):
+        """ Finds listings with no booked night in [start, end), in one
+        query that anti-joins the booked ranges.
+
+        params:
+        - start: First night of the stay, YYYY-MM-DD (str)
+        - end: Checkout date, exclusive, YYYY-MM-DD (str)
+        - min_price, max_price: Nightly price bounds in dollars (float)
+        - sort: "price", "price_desc" or "newest" (str)
+        - page: 1-based page number (int)
+        - size: Number of listings per page (int)
+
+        Returns:
+            (listings, has_next) for the requested page
+        """
+        start = datetime.strptime(start, '%Y-%m-%d').strftime('%Y-%m-%d')
+        end = datetime.strptime(end, '%Y-%m-%d').strftime('%Y-%m-%d')
+        if start >= end:
+            raise ValueError("Start date is same or after end date!")
+        orders = {
+            "price": (database.Listing.price.asc(),
+                      database.Listing.id.asc()),
+            "price_desc": (database.Listing.price.desc(),
+                           database.Listing.id.desc()),
+            "newest": (database.Listing.date_created.desc(),
+                       database.Listing.id.desc()),
+        }
+        if sort not in orders:
+            raise ValueError(f"Invalid sort: {sort}")
+
+        booked = database.BookedRange
+        overlapping = exists().where(
+            booked.listing_id == database.Listing.id,
+            booked.start_date < end, booked.end_date > start)
+        query = database.Listing.query.options(
+            joinedload(database.Listing.owner)).filter(~overlapping)
+        if min_price is not None:
+            query = query.filter(database.Listing.price >= min_price * 100)
+        if max_price is not None:
+            query = query.filter(database.Listing.price <= max_price * 100)
+
+        listings = query.order_by(*orders[sort]).offset(
+            (max(page, 1) - 1) * size).limit(size + 1).all()
+        return listings[:size], len(listings) > size
+
+    @staticmethod
+    def _encode_cursor(listing: database.Listing):
+        """ Encodes a listing's feed position as an opaque cursor """
+        key = f"{listing.date_created}|{listing.id}".encode()
+        return base64.urlsafe_b64encode(key).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str):
+        """ Decodes a feed cursor into (date_created, id), or None if the
+        cursor is missing or malformed.
+        """
+        if not cursor:
+            return None
+        try:
+            key = base64.urlsafe_b64decode(cursor.encode()).decode()
+            created, listing_id = key.split("|")
+            return created, int(listing_id)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            return None
+
     def add_booking_date(self, booked_dates: List[datetime]):
-        """ Adds booked dates to List of bookings """
-        for date in booked_dates:
-            date_db = database.Dates(date=date.strftime('%Y-%m-%d'),
-                                     listing_id=self.id)
-            with database.app.app_context():
-                db.session.add(date_db)
-                db.session.commit()
+        """ Adds booked dates to List of bookings in one transaction,
+        inserting every new booked range in a single batch.
+        """
+        with database.app_context():
+            ranges = Listing._to_ranges(booked_dates)
+            new_ranges = [{'listing_id': self.id,
+                           'start_date': start,
+                           'end_date': end}
+                          for start, end in ranges
+                          if not self._merge_adjacent(start, end)]
+            database.bulk_insert(database.BookedRange, new_ranges)
+            for start, end in ranges:
+                self._claim_window(start, end)
+            db.session.commit()
 
     def valid_booking_date(self, booked_dates: List[datetime]):
         """ Check if given booking start and ending dates are valid """
-        for date in booked_dates:
-            date = date.strftime('%Y-%m-%d')
-            if date in self.booked_dates:
+        for start, end in Listing._to_ranges(booked_dates):
+            if not self.is_available(start, end):
                 raise ValueError("Given dates overlap with existing bookings!")
         return True
 
     def find_min_booking_date(self):
         """ Finds the first available starting date a buyer can book from.
         Used for front end.
+
+        Reads the listing's stored first free window [next_available,
+        available_until), which booking keeps current: every night from
+        when it was stored up to next_available is booked, and none in the
+        window is. The booked ranges are only queried once today is past
+        the window.
+        """
+        today = Listing._today()
+        listing = self._current_row()
+        first, until = listing.next_available, listing.available_until
+        if first is not None:
+            if today <= first:
+                return first
+            if until is None or today < until:
+                return today
+        return self._free_window_from(today)[0]
+
+    @staticmethod
+    def _today():
+        return datetime.now().strftime('%Y-%m-%d')
+
+    @staticmethod
+    def _to_ranges(booked_dates: List[datetime]):
+        """ Groups dates into sorted, half-open (start, end) ranges of
+        consecutive nights.
         """
-        booked_dates = sorted(self.booked_dates, 
-                              key=lambda x: datetime.strptime(x, '%Y-%m-%d'))
-        # No bookings yet or earliest booking is after today
-        today = datetime.now().strftime('%Y-%m-%d')
-        if booked_dates == [] or (booked_dates[0] > today):
-            return today
-
-        # Find first available date, found when there's a gap between dates
-        prev_d = datetime.strptime(booked_dates[0], "%Y-%m-%d")
-        curr_d = prev_d
-        for i in range(1, len(booked_dates)):
-            curr_d = datetime.strptime(booked_dates[i], "%Y-%m-%d")
-            if (curr_d - prev_d).days > 1:
-                return (prev_d + timedelta(days=1)).strftime('%Y-%m-%d')
-            prev_d = curr_d
-
-        # No gaps exist, first available date is the day after latest booking
-        return (prev_d + timedelta(days=1)).strftime('%Y-%m-%d')
\ No newline at end of file
+        ranges = []
+        for date in sorted(set(booked_dates)):
+            if ranges and ranges[-1][1] == date:
+                ranges[-1][1] = date + timedelta(days=1)
+            else:
+                ranges.append([date, date + timedelta(days=1)])
+        return [(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+                for start, end in ranges]
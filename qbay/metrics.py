@@ -0,0 +1,345 @@
+# metrics.py
+"""
+Operational metrics, served at /metrics in the Prometheus text format.
+
+Each app records, in memory:
+- qbay_request_duration_seconds: histogram of request latency per Flask
+  endpoint
+- qbay_requests_total: requests per endpoint and status code
+- qbay_requests_in_flight: requests being answered per endpoint
+- qbay_bookings_total: bookings run by the booking dispatcher, per outcome
+  and failure reason (the ValueError raised by Booking.book_listing)
+The connection pool gauges and counters are read when metrics are
+collected.
+
+Under the pre-forking server each worker also writes its values to a file
+in QBAY_METRICS_DIR every FLUSH_SECONDS, and /metrics adds up the files of
+all workers, so whichever worker answers reports the whole server. The
+gauges of workers that have exited are dropped, and a running worker takes
+over their counters and deletes their files.
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from flask import g, request
+
+from qbay import database
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_SECONDS = 1.0
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Name -> (type, help), in the order they are reported
+METRICS = {
+    'qbay_request_duration_seconds': (
+        'histogram', 'Time taken to answer a request, per Flask endpoint'),
+    'qbay_requests_total': (
+        'counter', 'Requests answered, per endpoint and status code'),
+    'qbay_requests_in_flight': (
+        'gauge', 'Requests being answered, per endpoint'),
+    'qbay_bookings_total': (
+        'counter', 'Bookings run, per outcome and failure reason'),
+    'qbay_db_pool_size': (
+        'gauge', 'Connections the database pool keeps open'),
+    'qbay_db_pool_checked_out': (
+        'gauge', 'Database connections in use'),
+    'qbay_db_pool_overflow': (
+        'gauge', 'Database connections open beyond the pool size'),
+    'qbay_db_pool_checkouts_total': (
+        'counter', 'Database connections handed out'),
+    'qbay_db_pool_waits_total': (
+        'counter', 'Connection checkouts that had to wait'),
+    'qbay_db_pool_timeouts_total': (
+        'counter', 'Connection checkouts that timed out'),
+}
+_POOL_GAUGES = {'size': 'qbay_db_pool_size',
+                'checked_out': 'qbay_db_pool_checked_out',
+                'overflow': 'qbay_db_pool_overflow'}
+_POOL_COUNTERS = {'checkouts': 'qbay_db_pool_checkouts_total',
+                  'waits': 'qbay_db_pool_waits_total',
+                  'timeouts': 'qbay_db_pool_timeouts_total'}
+
+
+class Registry:
+    """The metric values an app recorded in this process.
+
+    Series are keyed by (metric name, labels), labels being a tuple of
+    (name, value) pairs. A histogram holds its count per bucket, then the
+    count above the last bucket, then the sum of the values observed.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def request_started(self, endpoint):
+        key = ('qbay_requests_in_flight', (('endpoint', endpoint),))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + 1
+
+    def request_finished(self, endpoint, status, seconds):
+        labels = (('endpoint', endpoint),)
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        total = ('qbay_requests_total', labels + (('status', str(status)),))
+        with self._lock:
+            self.gauges[('qbay_requests_in_flight', labels)] -= 1
+            histogram = self.histograms.get(
+                ('qbay_request_duration_seconds', labels))
+            if histogram is None:
+                histogram = [0] * (len(BUCKETS) + 2)
+                self.histograms[
+                    ('qbay_request_duration_seconds', labels)] = histogram
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+            self.counters[total] = self.counters.get(total, 0) + 1
+
+    def snapshot(self):
+        """Returns a copy of the values as a JSON-serializable dict"""
+        with self._lock:
+            return {kind: [[name, [list(pair) for pair in labels],
+                            list(value) if isinstance(value, list) else value]
+                           for (name, labels), value in values.items()]
+                    for kind, values in (('counters', self.counters),
+                                         ('gauges', self.gauges),
+                                         ('histograms', self.histograms))}
+
+    def adopt(self, snapshot):
+        """Adds the counters and histograms of another process's snapshot
+        to this registry's own
+        """
+        totals = {'counters': {}, 'gauges': {}, 'histograms': {}}
+        _merge(totals, snapshot, gauges=False)
+        with self._lock:
+            _merge_values(self.counters, totals['counters'])
+            _merge_values(self.histograms, totals['histograms'])
+
+
+def _merge_values(into, values):
+    for key, value in values.items():
+        if isinstance(value, list):
+            known = into.setdefault(key, [0] * len(value))
+            for i, count in enumerate(value):
+                known[i] += count
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+def _merge(totals, snapshot, gauges=True):
+    """Adds a snapshot's series to totals ({kind: {key: value}})"""
+    for kind in ('counters', 'gauges', 'histograms'):
+        if kind == 'gauges' and not gauges:
+            continue
+        _merge_values(totals[kind], {
+            (name, tuple(tuple(pair) for pair in labels)):
+                list(value) if isinstance(value, list) else value
+            for name, labels, value in snapshot.get(kind, [])})
+
+
+def booking_reason(message):
+    """Reduces a booking failure message to a label value, dropping the id
+    some messages end with and the input strptime quotes
+    """
+    if message.startswith('time data'):
+        return 'Invalid date'
+    return message.split(':', 1)[0]
+
+
+def record_booking(app, outcome, message=''):
+    """Counts a finished booking of the app, "booked" or "failed"; does
+    nothing if metrics are disabled
+    """
+    registry = app.extensions.get('qbay_metrics')
+    if registry is not None:
+        reason = booking_reason(message) if outcome == 'failed' else ''
+        registry.inc('qbay_bookings_total',
+                     (('outcome', outcome), ('reason', reason)))
+
+
+def snapshot(app):
+    """Returns the app's values in this process, with its pool's"""
+    values = app.extensions['qbay_metrics'].snapshot()
+    with app.app_context():
+        stats = database.pool_stats()
+    for kind, names in (('gauges', _POOL_GAUGES),
+                        ('counters', _POOL_COUNTERS)):
+        values[kind] += [[name, [], stats[key]]
+                         for key, name in names.items() if key in stats]
+    return values
+
+
+def _worker_file(directory, pid):
+    return os.path.join(directory, f'worker-{pid}.json')
+
+
+def _worker_files(directory):
+    """Yields (pid, path, snapshot) for each worker file in directory"""
+    for path in glob.glob(os.path.join(directory, 'worker-*.json')):
+        try:
+            pid = int(os.path.basename(path)[7:-5])
+            with open(path) as file:
+                yield pid, path, json.load(file)
+        except (OSError, ValueError):
+            continue  # Removed or adopted since it was listed
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def flush(app):
+    """Writes this process's values to its file in QBAY_METRICS_DIR"""
+    directory = app.config['QBAY_METRICS_DIR']
+    path = _worker_file(directory, os.getpid())
+    with open(path + '.tmp', 'w') as file:
+        json.dump(snapshot(app), file)
+    os.replace(path + '.tmp', path)
+
+
+def _adopt_exited(app):
+    """Takes over the counters of workers that have exited and deletes
+    their files, so files do not pile up as workers are recycled
+    """
+    import fcntl
+
+    directory = app.config['QBAY_METRICS_DIR']
+    with open(os.path.join(directory, 'adopt.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        adopted = []
+        for pid, path, values in _worker_files(directory):
+            if pid != os.getpid() and not _alive(pid):
+                app.extensions['qbay_metrics'].adopt(values)
+                adopted.append(path)
+        if adopted:
+            # Publish the adopted counters before their files go
+            flush(app)
+            for path in adopted:
+                os.unlink(path)
+
+
+def _flush_forever(app, stop):
+    while True:
+        _adopt_exited(app)
+        flush(app)
+        if stop.wait(FLUSH_SECONDS):
+            return
+
+
+def clear(directory):
+    """Deletes the worker files left in directory by an earlier server"""
+    for _, path, _ in _worker_files(directory):
+        os.unlink(path)
+
+
+def collect(app):
+    """Returns {kind: {(name, labels): value}} of the app in this process
+    and, with QBAY_METRICS_DIR, of every other worker
+    """
+    totals = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    _merge(totals, snapshot(app))
+    directory = app.config['QBAY_METRICS_DIR']
+    if directory:
+        for pid, _, values in _worker_files(directory):
+            if pid != os.getpid():
+                _merge(totals, values, gauges=_alive(pid))
+    return totals
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels) + '}'
+
+
+def render(totals):
+    """Formats collected values in the Prometheus text format"""
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        values = totals[kind + 's']
+        series = sorted((labels, value) for (metric, labels), value
+                        in values.items() if metric == name)
+        if not series:
+            continue
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+        for labels, value in series:
+            if kind != 'histogram':
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                continue
+            count = 0
+            for bound, observed in zip(BUCKETS + ('+Inf',), value):
+                count += observed
+                lines.append(f'{name}_bucket'
+                             f'{_labels(labels + (("le", bound),))} {count}')
+            lines.append(f'{name}_sum{_labels(labels)} {value[-1]!r}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    """Records request metrics for the app if QBAY_METRICS is enabled"""
+    if not app.config['QBAY_METRICS']:
+        return
+    registry = app.extensions['qbay_metrics'] = Registry()
+
+    def start_request():
+        g.metrics_started = time.perf_counter()
+        g.metrics_endpoint = request.endpoint or 'none'
+        registry.request_started(g.metrics_endpoint)
+
+    def keep_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    def finish_request(_):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            registry.request_finished(g.pop('metrics_endpoint'),
+                                      g.pop('metrics_status', 500),
+                                      time.perf_counter() - started)
+
+    app.before_request(start_request)
+    app.after_request(keep_status)
+    app.teardown_request(finish_request)
+
+
+def start(app):
+    """Starts writing the app's values to this process's file in
+    QBAY_METRICS_DIR, for server workers
+    """
+    if 'qbay_metrics' in app.extensions and app.config['QBAY_METRICS_DIR']:
+        stop = threading.Event()
+        thread = threading.Thread(target=_flush_forever, args=(app, stop),
+                                  daemon=True, name='qbay-metrics')
+        app.extensions['qbay_metrics_flusher'] = stop, thread
+        thread.start()
+
+
+def shutdown(app):
+    """Stops writing the app's metrics file after a final write"""
+    stop, thread = app.extensions.pop('qbay_metrics_flusher', (None, None))
+    if stop is not None:
+        stop.set()
+        thread.join()
+        flush(app)
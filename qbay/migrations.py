@@ -0,0 +1,280 @@
+# migrations.py
+"""
+Versioned schema migrations.
+
+The schema version is kept in a one-row schema_version table. Version 1 is
+the original schema (per-night dates rows, no secondary indexes), which
+predates the version table. Every migration upgrades a database in place
+from the previous version, on both SQLite and MySQL, without losing data.
+
+Migrations describe their tables explicitly rather than through the models
+in database.py, so they keep working as the models change.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import (Column, ForeignKey, Index, Integer, MetaData, String,
+                        Table, func, inspect, literal, select, text)
+
+from qbay import database
+
+_metadata = MetaData()
+
+schema_version = Table('schema_version', _metadata,
+                       Column('version', Integer, nullable=False))
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Registers a function upgrading the schema from version - 1"""
+    def register(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        return upgrade
+    return register
+
+
+@migration(2, "Replace per-night dates rows with booked ranges")
+def _booked_ranges(connection):
+    booked_ranges = Table(
+        'booked_ranges', MetaData(),
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        Column('listing_id', Integer, ForeignKey('listings.id'),
+               nullable=False),
+        Column('start_date', String(10), nullable=False),
+        Column('end_date', String(10), nullable=False),
+        Index('ix_booked_ranges_listing_end', 'listing_id', 'end_date'))
+    # Reflect listings so the foreign key above can be resolved
+    Table('listings', booked_ranges.metadata, autoload_with=connection)
+    booked_ranges.create(connection, checkfirst=True)
+
+    if not inspect(connection).has_table('dates'):
+        return
+    dates = Table('dates', MetaData(), autoload_with=connection)
+    rows = connection.execute(
+        select(dates.c.listing_id, dates.c.date).distinct().order_by(
+            dates.c.listing_id, dates.c.date))
+
+    # Merge consecutive nights of a listing into one half-open range
+    ranges = []
+    for listing_id, date in rows:
+        night = datetime.strptime(date, '%Y-%m-%d')
+        following = (night + timedelta(days=1)).strftime('%Y-%m-%d')
+        last = ranges[-1] if ranges else None
+        if (last and last['listing_id'] == listing_id
+                and last['end_date'] == date):
+            last['end_date'] = following
+        else:
+            ranges.append({'listing_id': listing_id, 'start_date': date,
+                           'end_date': following})
+    if ranges:
+        connection.execute(booked_ranges.insert(), ranges)
+    dates.drop(connection)
+
+
+@migration(3, "Index hot lookup columns")
+def _lookup_indexes(connection):
+    tables = MetaData()
+    indexes = [
+        ('listings', 'ix_listings_created_id', ['date_created', 'id']),
+        ('listings', 'ix_listings_title', ['title']),
+        ('listings', 'ix_listings_owner_id', ['owner_id']),
+        ('bookings', 'ix_bookings_buyer_id', ['buyer_id']),
+        ('bookings', 'ix_bookings_listing_id', ['listing_id']),
+        ('reviews', 'ix_reviews_listing_id', ['listing_id']),
+    ]
+    inspector = inspect(connection)
+    for table_name, name, columns in indexes:
+        existing = {i['name'] for i in inspector.get_indexes(table_name)}
+        if name in existing:
+            continue
+        table = Table(table_name, tables, autoload_with=connection,
+                      extend_existing=True)
+        Index(name, *[table.c[c] for c in columns]).create(connection)
+
+    # A booked range may only start once per listing; ranges never overlap
+    existing = {u['name'] for u in
+                inspector.get_unique_constraints('booked_ranges')}
+    existing |= {i['name'] for i in inspector.get_indexes('booked_ranges')}
+    if 'uq_booked_ranges_listing_start' not in existing:
+        table = Table('booked_ranges', tables, autoload_with=connection)
+        Index('uq_booked_ranges_listing_start', table.c.listing_id,
+              table.c.start_date, unique=True).create(connection)
+
+
+@migration(4, "Add the listing full-text index")
+def _listing_search(connection):
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql(database.LISTINGS_FTS_SQLITE)
+        connection.execute(text(
+            "INSERT INTO listings_fts(rowid, title, description, address) "
+            "SELECT id, title, description, address FROM listings "
+            "WHERE id NOT IN (SELECT rowid FROM listings_fts)"))
+    elif connection.dialect.name == 'mysql':
+        existing = {i['name'] for i in inspect(connection).get_indexes(
+            'listings')}
+        if 'ft_listings_search' not in existing:
+            connection.exec_driver_sql(database.LISTINGS_FTS_MYSQL)
+
+
+@migration(5, "Index listing prices for availability search")
+def _price_index(connection):
+    existing = {i['name'] for i in inspect(connection).get_indexes(
+        'listings')}
+    if 'ix_listings_price_id' not in existing:
+        listings = Table('listings', MetaData(), autoload_with=connection)
+        Index('ix_listings_price_id', listings.c.price,
+              listings.c.id).create(connection)
+
+
+@migration(6, "Make listing titles unique")
+def _unique_titles(connection):
+    listings = Table('listings', MetaData(), autoload_with=connection)
+    # Titles were only checked before insert, so concurrent creates could
+    # duplicate one; every copy but the oldest gets its id appended
+    duplicates = connection.execute(
+        select(listings.c.title).group_by(listings.c.title).having(
+            func.count() > 1)).scalars().all()
+    for title in duplicates:
+        ids = connection.execute(
+            select(listings.c.id).where(listings.c.title == title).order_by(
+                listings.c.id)).scalars().all()
+        for listing_id in ids[1:]:
+            connection.execute(
+                listings.update().where(listings.c.id == listing_id).values(
+                    title=f"{title} {listing_id}"))
+
+    existing = {i['name'] for i in inspect(connection).get_indexes(
+        'listings')}
+    if 'ix_listings_title' in existing:
+        Index('ix_listings_title', listings.c.title).drop(connection)
+    if 'uq_listings_title' not in existing:
+        Index('uq_listings_title', listings.c.title,
+              unique=True).create(connection)
+
+
+@migration(7, "Add the balance ledger")
+def _balance_ledger(connection):
+    tables = MetaData()
+    users = Table('users', tables, autoload_with=connection)
+    Table('bookings', tables, autoload_with=connection)
+    ledger = Table(
+        'balance_ledger', tables,
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+        Column('delta', Integer, nullable=False),
+        Column('reason', String(20), nullable=False),
+        Column('booking_id', Integer, ForeignKey('bookings.id'),
+               nullable=True),
+        Column('created_at', String(19), nullable=False),
+        Index('ix_balance_ledger_user_id', 'user_id', 'id'))
+    if inspect(connection).has_table('balance_ledger'):
+        return
+    ledger.create(connection)
+    # Balances held whole dollars; like prices they now count cents
+    connection.execute(users.update().values(balance=users.c.balance * 100))
+    # Current balances become the opening entries
+    now = datetime.now().isoformat(sep=' ', timespec='seconds')
+    connection.execute(ledger.insert().from_select(
+        ['user_id', 'delta', 'reason', 'created_at'],
+        select(users.c.id, users.c.balance, literal('opening'),
+               literal(now))))
+
+
+@migration(8, "Store each listing's first free window")
+def _free_windows(connection):
+    existing = {c['name'] for c in inspect(connection).get_columns(
+        'listings')}
+    for name in ('next_available', 'available_until'):
+        if name not in existing:
+            connection.execute(text(
+                f"ALTER TABLE listings ADD COLUMN {name} VARCHAR(10)"))
+    tables = MetaData()
+    listings = Table('listings', tables, autoload_with=connection)
+    booked_ranges = Table('booked_ranges', tables, autoload_with=connection)
+    today = datetime.now().strftime('%Y-%m-%d')
+    rows = connection.execute(
+        select(booked_ranges.c.listing_id, booked_ranges.c.start_date,
+               booked_ranges.c.end_date).where(
+            booked_ranges.c.end_date > today).order_by(
+            booked_ranges.c.listing_id, booked_ranges.c.start_date))
+
+    # Walk each listing's ranges from today to its first gap
+    windows = {}
+    for listing_id, start, end in rows:
+        first, until = windows.get(listing_id, (today, None))
+        if until is not None:
+            continue
+        if start > first:
+            windows[listing_id] = (first, start)
+        else:
+            windows[listing_id] = (max(first, end), None)
+    connection.execute(listings.update().values(next_available=today))
+    for listing_id, (first, until) in windows.items():
+        connection.execute(
+            listings.update().where(listings.c.id == listing_id).values(
+                next_available=first, available_until=until))
+
+
+def head():
+    """Returns the schema version the models in database.py describe"""
+    return max(version for version, _, _ in MIGRATIONS)
+
+
+def current_version(connection):
+    """Returns the schema version of the database.
+
+    Databases created before versioning report version 1, and empty
+    databases report version 0.
+    """
+    inspector = inspect(connection)
+    if not inspector.has_table('schema_version'):
+        return 1 if inspector.has_table('users') else 0
+    version = connection.execute(select(schema_version.c.version)).scalar()
+    return version or 0
+
+
+def stamp(connection, version):
+    """Records the database as being at the given schema version"""
+    schema_version.create(connection, checkfirst=True)
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert(), {'version': version})
+
+
+def upgrade(engine):
+    """Brings the database up to the head schema version.
+
+    An empty database gets the current schema created directly. Anything
+    older runs each pending migration in its own transaction and records
+    its version, so an interrupted upgrade resumes where it stopped.
+
+    Returns the list of versions applied.
+    """
+    with engine.begin() as connection:
+        version = current_version(connection)
+        if version == 0:
+            database.db.metadata.create_all(connection)
+            stamp(connection, head())
+            return []
+
+    applied = []
+    for target, _, upgrade_schema in sorted(MIGRATIONS):
+        if target <= version:
+            continue
+        with engine.begin() as connection:
+            upgrade_schema(connection)
+            stamp(connection, target)
+        applied.append(target)
+    return applied
+
+
+def reset(engine):
+    """Drops every table, including the schema version, and recreates the
+    current schema. All data is lost.
+    """
+    with engine.begin() as connection:
+        for table_name in ('dates',):  # tables from older schema versions
+            if inspect(connection).has_table(table_name):
+                Table(table_name, MetaData(),
+                      autoload_with=connection).drop(connection)
+        database.db.metadata.drop_all(connection)
+        schema_version.drop(connection, checkfirst=True)
+    upgrade(engine)
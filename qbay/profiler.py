@@ -0,0 +1,182 @@
+# profiler.py
+"""
+Opt-in per-request profiling, enabled with QBAY_PROFILE (env profile=1).
+
+Each request records its wall time, the SQL statements it ran and the time
+they took, and the time spent rendering templates, not counting SQL run
+from inside templates (lazy loads). What is left is the app's own Python
+time. The breakdown is sent in a Server-Timing header, which browser
+developer tools show with the request, and the slowest requests are kept
+for /debug/profile.
+
+Statements the booking dispatcher runs on its own threads are not counted
+towards the request waiting for them. Every worker process profiles only
+the requests it serves.
+"""
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime
+from flask import (before_render_template, current_app,
+                   has_request_context, request, template_rendered)
+from sqlalchemy import event
+
+from qbay.database import db
+
+
+class Profile:
+    """Timings of one request, in seconds"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql = 0.0
+        self.render = 0.0
+        self.render_sql = 0.0  # SQL time spent inside templates
+        self.rendering = []  # start times of templates being rendered
+
+    def timings(self):
+        """Returns (total, sql, render, app) in seconds up to now"""
+        total = time.perf_counter() - self.started
+        render = self.render - self.render_sql
+        return total, self.sql, render, max(total - self.sql - render, 0)
+
+
+class SlowLog:
+    """Keeps the slowest requests recorded over a rolling time window.
+
+    Requests are only compared with the ones kept when they are recorded,
+    so after the slowest expire the log fills with newer requests again.
+
+    params:
+    - size: Most requests kept (int)
+    - window: Seconds a request is kept for (float)
+    """
+
+    def __init__(self, size: int = 50, window: float = 300):
+        self.size = size
+        self.window = window
+        self._heap = []  # (seconds, sequence, recorded at, entry)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        oldest = now - self.window
+        if any(item[2] <= oldest for item in self._heap):
+            self._heap = [item for item in self._heap if item[2] > oldest]
+            heapq.heapify(self._heap)
+
+    def add(self, seconds: float, entry: dict):
+        now = time.monotonic()
+        item = (seconds, next(self._sequence), now, entry)
+        with self._lock:
+            self._expire(now)
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, item)
+            elif seconds > self._heap[0][0]:
+                heapq.heapreplace(self._heap, item)
+
+    def slowest(self):
+        """Returns the entries kept, slowest first"""
+        with self._lock:
+            self._expire(time.monotonic())
+            return [item[3] for item in sorted(self._heap, reverse=True)]
+
+
+def _profile():
+    # Kept on the request rather than g, which the domain layer's nested
+    # app contexts do not share
+    if has_request_context():
+        return request.environ.get('qbay.profile')
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None and _profile() is not None:
+        context._qbay_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = getattr(context, '_qbay_started', None)
+    profile = _profile()
+    if started is None or profile is None:
+        return
+    elapsed = time.perf_counter() - started
+    profile.queries += 1
+    profile.sql += elapsed
+    if profile.rendering:
+        profile.render_sql += elapsed
+
+
+def _render_started(app, template, context, **extra):
+    profile = _profile()
+    if profile is not None:
+        profile.rendering.append(time.perf_counter())
+
+
+def _render_finished(app, template, context, **extra):
+    profile = _profile()
+    if profile is not None and profile.rendering:
+        started = profile.rendering.pop()
+        # Only the outermost template counts, nested ones are inside it
+        if not profile.rendering:
+            profile.render += time.perf_counter() - started
+
+
+def _start_request():
+    request.environ['qbay.profile'] = Profile()
+
+
+def _finish_request(response):
+    profile = request.environ.pop('qbay.profile', None)
+    if profile is None:
+        return response
+    total, sql, render, app_time = profile.timings()
+    response.headers['Server-Timing'] = (
+        f'sql;dur={sql * 1000:.2f};desc="{profile.queries} queries", '
+        f'render;dur={render * 1000:.2f}, app;dur={app_time * 1000:.2f}, '
+        f'total;dur={total * 1000:.2f}')
+    current_app.extensions['qbay_profiler'].add(total, {
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'total_ms': round(total * 1000, 3),
+        'sql_ms': round(sql * 1000, 3),
+        'queries': profile.queries,
+        'render_ms': round(render * 1000, 3),
+        'app_ms': round(app_time * 1000, 3),
+        'at': datetime.now().isoformat(timespec='seconds'),
+    })
+    return response
+
+
+def init_app(app):
+    """Profiles every request of the app if QBAY_PROFILE is enabled. Call
+    before registering blueprints, so the timing covers their hooks.
+    """
+    if not app.config['QBAY_PROFILE']:
+        return
+    app.extensions['qbay_profiler'] = SlowLog(
+        app.config['QBAY_PROFILE_SLOWEST'],
+        app.config['QBAY_PROFILE_WINDOW'])
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute',
+                     _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute',
+                     _after_cursor_execute)
+
+
+def slowest(app):
+    """Returns the slowest requests the app's profiler kept, or an empty
+    list if profiling is disabled.
+    """
+    log = app.extensions.get('qbay_profiler')
+    return log.slowest() if log else []
@@ -0,0 +1,87 @@
+# search.py
+"""
+Full-text search over listing titles, descriptions and addresses.
+
+On SQLite the index is the listings_fts FTS5 table, which has to be kept in
+sync through index_listing whenever a listing is created or its text
+changes. On MySQL it is the ft_listings_search FULLTEXT index, which the
+server maintains itself.
+"""
+import re
+from sqlalchemy import bindparam, text
+
+from qbay.database import db
+
+# Deepest result reachable by paging; ranking needs every match scored, so
+# deep pages on broad queries get expensive
+MAX_RESULTS = 1000
+
+# Relevance weights of title, description and address matches
+_SQLITE_SEARCH = text(
+    "SELECT rowid FROM listings_fts WHERE listings_fts MATCH :match "
+    "ORDER BY bm25(listings_fts, 10.0, 1.0, 2.0) "
+    "LIMIT :limit OFFSET :offset")
+_MYSQL_SEARCH = text(
+    "SELECT id FROM listings "
+    "WHERE MATCH(title, description, address) "
+    "AGAINST (:match IN BOOLEAN MODE) "
+    "ORDER BY MATCH(title, description, address) "
+    "AGAINST (:match IN BOOLEAN MODE) DESC "
+    "LIMIT :limit OFFSET :offset")
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def terms(query: str):
+    """Splits a user's query into at most 16 lowercase search terms"""
+    return re.findall(r'\w+', (query or '').lower())[:16]
+
+
+def index_listing(listing):
+    """Stages a listing's searchable text in the full-text index, in the
+    transaction that creates or changes the listing. The listing must have
+    been flushed so it has an id.
+    """
+    if _dialect() != 'sqlite':
+        return
+    db.session.execute(text("DELETE FROM listings_fts WHERE rowid = :id"),
+                       {'id': listing.id})
+    db.session.execute(
+        text("INSERT INTO listings_fts(rowid, title, description, address) "
+             "VALUES (:id, :title, :description, :address)"),
+        {'id': listing.id, 'title': listing.title,
+         'description': listing.description, 'address': listing.address})
+
+
+def index_listings(ids):
+    """Stages the searchable text of the listings with the given ids in
+    the full-text index, for listings written with bulk inserts.
+    """
+    ids = list(ids)
+    if _dialect() != 'sqlite' or not ids:
+        return
+    db.session.execute(
+        text("INSERT INTO listings_fts(rowid, title, description, address) "
+             "SELECT id, title, description, address FROM listings "
+             "WHERE id IN :ids").bindparams(bindparam('ids', expanding=True)),
+        {'ids': ids})
+
+
+def search_ids(query: str, limit: int, offset: int = 0):
+    """Returns the ids of listings matching every term of the query (each
+    as a prefix), best match first.
+    """
+    words = terms(query)
+    if not words:
+        return []
+    if _dialect() == 'sqlite':
+        statement = _SQLITE_SEARCH
+        match = ' '.join(f'"{word}"*' for word in words)
+    else:
+        statement = _MYSQL_SEARCH
+        match = ' '.join(f'+{word}*' for word in words)
+    rows = db.session.execute(statement, {'match': match, 'limit': limit,
+                                          'offset': offset})
+    return [row[0] for row in rows]
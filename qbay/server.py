@@ -0,0 +1,251 @@
+# server.py
+"""
+Pre-forking production server, used by `python -m qbay serve`.
+
+The parent process binds the listening socket, then forks worker processes
+that accept on it. Each worker builds its own app and database engine and
+serves requests on a fixed pool of threads. The parent only supervises:
+it replaces workers that exit, restarts all workers gracefully on SIGHUP
+and shuts down gracefully on SIGTERM or SIGINT. Workers recycle themselves
+after a number of requests to bound memory growth.
+
+POSIX only, as it relies on os.fork.
+"""
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+
+from qbay import database, dispatcher, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PoolWSGIServer(BaseWSGIServer):
+    """Werkzeug WSGI server that handles connections on a thread pool and
+    stops accepting after max_requests connections (0 for no limit).
+    """
+
+    def __init__(self, app, fd, threads, max_requests=0):
+        super().__init__('', 0, app, fd=fd)
+        # Every worker is woken for each connection but only one accepts
+        # it; the others must not block in accept, or they stop noticing
+        # shutdown. A failed accept is ignored by socketserver.
+        self.socket.setblocking(False)
+        self.max_requests = max_requests
+        self.handled = 0
+        self._pool = ThreadPoolExecutor(threads, thread_name_prefix='qbay')
+        self._count_lock = threading.Lock()
+        self._stopping = False
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+        with self._count_lock:
+            self.handled += 1
+            recycle = (self.max_requests
+                       and self.handled >= self.max_requests)
+        if recycle:
+            self.stop()
+
+    def stop(self):
+        """Stops accepting connections without blocking the caller;
+        requests already accepted are still completed.
+        """
+        if not self._stopping:
+            self._stopping = True
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self._pool.shutdown(wait=True)
+
+
+class Arbiter:
+    """Supervises the pre-forked worker processes.
+
+    params:
+    - host: Interface to listen on (str)
+    - port: Port to listen on (int)
+    - workers: Number of worker processes (int)
+    - threads: Request threads per worker (int)
+    - max_requests: Requests after which a worker is replaced, 0 to never
+      recycle; a random jitter keeps workers from recycling at once (int)
+    - config: Settings passed to database.create_app in workers (dict)
+    """
+
+    def __init__(self, host='0.0.0.0', port=8081, workers=None, threads=4,
+                 max_requests=1000, config=None):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.max_requests = max_requests
+        self.config = config or {}
+        self.metrics_dir = None
+        self.socket = None
+        self._children = {}  # pid -> generation
+        self._generation = 0
+        self._signals = []
+
+    def run(self):
+        """Serves until SIGTERM or SIGINT, returning the exit status"""
+        # Create or upgrade the schema once, then drop the parent's
+        # connections so no worker inherits them
+        app = database.create_app(self.config)
+        with app.app_context():
+            database.db.engine.dispose()
+        # Workers add up their metrics through files in a shared directory
+        self.metrics_dir = app.config['QBAY_METRICS_DIR']
+        own_metrics_dir = app.config['QBAY_METRICS'] and not self.metrics_dir
+        if own_metrics_dir:
+            self.metrics_dir = tempfile.mkdtemp(prefix='qbay-metrics-')
+        elif self.metrics_dir:
+            metrics.clear(self.metrics_dir)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(128)
+        self.socket.set_inheritable(True)
+        logger.info("Listening on %s:%s with %s workers x %s threads",
+                    self.host, self.port, self.workers, self.threads)
+
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, lambda signum, _: self._signals.append(signum))
+        self._spawn_missing()
+        try:
+            while True:
+                if self._signals:
+                    signum = self._signals.pop(0)
+                    if signum == signal.SIGHUP:
+                        self._restart()
+                    else:
+                        break
+                self._reap()
+                self._spawn_missing()
+                time.sleep(0.1)
+        finally:
+            self._stop_children(list(self._children))
+            self.socket.close()
+            if own_metrics_dir:
+                shutil.rmtree(self.metrics_dir, ignore_errors=True)
+        logger.info("Shut down")
+        return 0
+
+    def _spawn_missing(self):
+        current = [pid for pid, gen in self._children.items()
+                   if gen == self._generation]
+        for _ in range(self.workers - len(current)):
+            self._spawn()
+
+    def _spawn(self):
+        max_requests = self.max_requests
+        if max_requests:
+            max_requests += random.randint(0, max(max_requests // 10, 1))
+        # Block signals across the fork so a new worker cannot receive one
+        # while it still has the parent's handlers
+        signals = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        pid = os.fork()
+        if pid:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            self._children[pid] = self._generation
+            return
+        # Worker process
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for sig in (signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_IGN)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+        status = 0
+        try:
+            self._work(max_requests)
+        except Exception:
+            logger.exception("Worker %s failed", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _work(self, max_requests):
+        app = database.create_app(dict(self.config,
+                                       QBAY_BOOTSTRAP_SCHEMA=False,
+                                       QBAY_METRICS_DIR=self.metrics_dir))
+        metrics.start(app)
+        server = PoolWSGIServer(app, self.socket.fileno(), self.threads,
+                                max_requests)
+        signal.signal(signal.SIGTERM, lambda *_: server.stop())
+        logger.info("Worker %s started", os.getpid())
+        server.serve_forever()
+        dispatcher.shutdown(app)
+        metrics.shutdown(app)
+        logger.info("Worker %s exiting after %s requests", os.getpid(),
+                    server.handled)
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self._children.pop(pid, None)
+
+    def _restart(self):
+        """Starts a new generation of workers, then stops the old one once
+        it has finished its in-flight requests.
+        """
+        logger.info("Restarting workers")
+        old = list(self._children)
+        self._generation += 1
+        self._spawn_missing()
+        self._stop_children(old)
+
+    def _stop_children(self, pids, timeout=30):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + timeout
+        for pid in pids:
+            while pid in self._children:
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = pid
+                if done:
+                    self._children.pop(pid, None)
+                elif time.monotonic() > deadline:
+                    os.kill(pid, signal.SIGKILL)
+                else:
+                    time.sleep(0.05)
+
+
+def serve(host='0.0.0.0', port=8081, workers=None, threads=4,
+          max_requests=1000, config=None):
+    """Runs the pre-forking server until it is told to stop"""
+    if not hasattr(os, 'fork'):
+        sys.exit("The pre-forking server needs os.fork; use `python -m "
+                 "qbay run` on this platform")
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(process)d] %(levelname)s %(message)s')
+    return Arbiter(host, port, workers, threads, max_requests,
+                   config).run()
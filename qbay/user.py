@@ -5,14 +5,21 @@ import re
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import exc, update, delete, insert, select
+from sqlalchemy.orm import make_transient_to_detached
 
-from qbay import database
+from qbay import database, ledger
+from qbay.cache import LRUCache
 from qbay.database import db
 
 if TYPE_CHECKING:
     from .listing import Listing
     from .review import Review
 
+# Detached copies of hot users' rows, keyed by id. Entries are dropped
+# whenever this process changes the user; the TTL bounds how stale a user
+# changed by another process can get.
+user_cache = LRUCache(maxsize=1024, ttl=30)
+
 
 class User():
     """ Object representation of a user's account
@@ -54,11 +61,13 @@ class User():
                              password=self.password,
                              postal_code=self.postal_code,
                              billing_address=self.billing_address,
-                             balance=self.balance)
+                             balance=round(self.balance * 100))
 
         try:
-            with database.app.app_context():
+            with database.app_context():
                 db.session.add(user)
+                db.session.flush()
+                ledger.open_account(user.id, user.balance)
                 db.session.commit()
                 self._database_obj = user
                 self._id = user.id
@@ -122,9 +131,9 @@ class User():
 
     @property
     def balance(self):
-        """ Fetches the user's balance """
+        """ Fetches the user's balance in dollars, stored in cents """
         if self.database_obj:
-            self._balance = self.database_obj.balance
+            self._balance = self.database_obj.balance / 100
         return self._balance
 
     @balance.setter
@@ -298,7 +307,7 @@ class User():
         """
         if not (User.valid_email(email) and User.valid_password(password)):
             raise ValueError("Invalid email or password")
-        with database.app.app_context():
+        with database.app_context():
             user = database.User.query.filter_by(email=email).first()
 
             if user:
@@ -320,6 +329,12 @@ class User():
         except exc.IntegrityError:
             db.session.rollback()
             raise ValueError(f"Username already exists: {username}")
+        finally:
+            User.invalidate_cache(self.id)
+        # Cards of the user's listings show their owner's username
+        from qbay.listing import Listing
+        Listing.invalidate_cache(*[id for id, in db.session.query(
+            database.Listing.id).filter_by(owner_id=self.id)])
 
     def update_email(self, email):
         """Updates the user's email and pushes changes to the 
@@ -334,6 +349,7 @@ class User():
             db.session.commit()
         except exc.IntegrityError:
             db.session.rollback()
+        User.invalidate_cache(self.id)
 
     def update_billing_address(self, address):
         """Updates the billing address and pushes changes to the 
@@ -342,6 +358,7 @@ class User():
         self.billing_address = address
         self.database_obj.billing_address = address
         db.session.commit()
+        User.invalidate_cache(self.id)
 
     def update_postal_code(self, postal_code):
         """Updates the postal code and pushes changes to the 
@@ -350,17 +367,25 @@ class User():
         self.postal_code = postal_code
         self.database_obj.postal_code = postal_code
         db.session.commit()
+        User.invalidate_cache(self.id)
     
     def update_balance(self, value):
         """Updates the user's balance and pushes changes to the 
         database.
         """
         self.balance = value
-        self.database_obj.balance = value
-        db.session.commit()
+        try:
+            database.begin_write()
+            ledger.set_balance(self.id, round(value * 100))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            User.invalidate_cache(self.id)
 
     @staticmethod
-    def query_user(id):
+    def query_user(id, cached=False):
         """Returns an User object for interacting with the database
         in a safe manner. It will initialize a new User object that
         is tethered to the corresponding database object
@@ -368,15 +393,44 @@ class User():
         Args:
             id (int): integer denoting the unique identifier of the object
             to be queried for
+            cached (bool): allow the row to come from the process-wide
+            user cache instead of the database
 
         Returns:
             User: an user object that is tethered to the corresponding
             database object with the given id
         """
-        database_user = database.User.query.get(int(id))
+        if cached:
+            database_user = User._cached_row(int(id))
+        else:
+            database_user = database.User.query.get(int(id))
         if database_user:
             user = User()
             user._database_obj = database_user
-            user.balance = user.database_obj.balance
+            user.balance = user.database_obj.balance / 100
             return user
         return None
+
+    @staticmethod
+    def _cached_row(id):
+        """Returns the database row of the user with the given id, attached
+        to the current session, using the user cache when possible.
+        """
+        row = user_cache.get(id)
+        if row is not None:
+            # Copies the cached state into the session without a query
+            return db.session.merge(row, load=False)
+        database_user = database.User.query.get(id)
+        if database_user:
+            columns = database.User.__mapper__.column_attrs
+            row = database.User(**{c.key: getattr(database_user, c.key)
+                                   for c in columns})
+            make_transient_to_detached(row)
+            user_cache.put(id, row)
+        return database_user
+
+    @staticmethod
+    def invalidate_cache(id):
+        """Drops the user with the given id from the user cache"""
+        if id is not None:
+            user_cache.pop(int(id))
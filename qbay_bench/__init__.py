@@ -0,0 +1,19 @@
+'''
+Benchmarks for the qbay backend. Each module is runnable on its own, e.g.
+    python -m qbay_bench.booking_contention
+and works on a throwaway SQLite database unless db_string is set.
+'''
+import os
+import tempfile
+
+# qbay connects when it is imported, so this runs before any benchmark
+# module imports it
+if not os.getenv('db_string'):
+    _db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['db_string'] = 'sqlite:///' + _db_file
+
+
+def percentile(samples, fraction):
+    """Returns the sample below which the given fraction of samples fall"""
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
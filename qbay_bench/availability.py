@@ -0,0 +1,87 @@
+"""
+Availability search benchmark.
+
+For each catalogue size, fills a throwaway database with synthetic
+listings and booked ranges, then times Listing.available for random stays
+and price filters and reports p50/p95 latency, to show how the single
+anti-join query scales with the catalogue.
+
+    python -m qbay_bench.availability --sizes 1000,10000,100000
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+from qbay import database
+from qbay.database import app, db
+from qbay.listing import Listing
+from qbay_bench import percentile
+
+FIRST_DAY = date(2030, 1, 1)
+
+
+def populate(listings, ranges_per_listing, seed, batch_size=10000):
+    """Bulk inserts listings, each with non-overlapping booked ranges"""
+    rand = random.Random(seed)
+
+    def listing_rows():
+        for i in range(1, listings + 1):
+            yield {'id': i, 'title': f"Listing {i}",
+                   'description': "A synthetic listing for benchmarks",
+                   'price': rand.randrange(1000, 100000, 100),
+                   'address': f"{i} Bench Street",
+                   'date_created': '2022-11-01',
+                   'last_modified_date': '2022-11-01', 'owner_id': 1}
+
+    def range_rows():
+        for i in range(1, listings + 1):
+            day = FIRST_DAY
+            for _ in range(ranges_per_listing):
+                start = day + timedelta(days=rand.randint(0, 10))
+                day = start + timedelta(days=rand.randint(1, 7))
+                yield {'listing_id': i, 'start_date': start.isoformat(),
+                       'end_date': day.isoformat()}
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        database.bulk_insert(database.Listing, listing_rows(), batch_size)
+        database.bulk_insert(database.BookedRange, range_rows(), batch_size)
+        db.session.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma-separated catalogue sizes')
+    parser.add_argument('--ranges', type=int, default=20,
+                        help='booked ranges per listing')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=327)
+    args = parser.parse_args(argv)
+
+    for size in [int(s) for s in args.sizes.split(',')]:
+        populate(size, args.ranges, args.seed)
+        rand = random.Random(args.seed)
+        latencies = []
+        with app.app_context():
+            for _ in range(args.queries):
+                start = FIRST_DAY + timedelta(days=rand.randint(0, 180))
+                end = start + timedelta(days=rand.randint(1, 7))
+                low = rand.choice([None, 50, 200])
+                high = rand.choice([None, 400, 1000])
+                began = time.perf_counter()
+                Listing.available(start.isoformat(), end.isoformat(),
+                                  low, high, rand.choice(["price",
+                                                          "newest"]))
+                latencies.append((time.perf_counter() - began) * 1000)
+        print(f"listings={size} queries={args.queries} "
+              f"p50={statistics.median(latencies):.2f}ms "
+              f"p95={percentile(latencies, 0.95):.2f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,144 @@
+"""
+Booking contention benchmark.
+
+Many buyer threads book random stays on a small number of listings at once.
+Reports booking attempts and successful bookings per second, then checks
+that no night was booked twice, that no money was created or lost, and
+that every balance matches the balance ledger.
+
+    python -m qbay_bench.booking_contention --threads 8 --attempts 50
+"""
+import argparse
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from qbay import database, ledger
+from qbay.database import app, db
+from qbay.user import User
+from qbay.listing import Listing
+from qbay.booking import Booking
+
+START_BALANCE = 10 ** 7  # dollars
+
+
+def setup(buyers, listings):
+    """Creates one owner, the buyers and the listings to book.
+
+    Returns the owner id, the buyer ids and the listing ids.
+    """
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        User.register("Owner", "owner@bench.com", "Password123!")
+        owner = User.query_user(
+            User.login("owner@bench.com", "Password123!").id)
+        buyer_ids = []
+        for i in range(buyers):
+            email = f"buyer{i}@bench.com"
+            User.register(f"Buyer {i}", email, "Password123!")
+            buyer = User.query_user(User.login(email, "Password123!").id)
+            buyer.update_balance(START_BALANCE)
+            buyer_ids.append(buyer.id)
+        owner.update_balance(START_BALANCE)
+        listing_ids = []
+        for i in range(listings):
+            listing = Listing.create_listing(
+                f"Bench listing {i}", "A listing used for benchmarking",
+                100, owner, "1 Bench Street")
+            listing_ids.append(listing.id)
+        return owner.id, buyer_ids, listing_ids
+
+
+def buyer_thread(buyer_id, owner_id, listing_ids, attempts, days, seed,
+                 results):
+    """Books random stays of 1-3 nights and records the outcomes"""
+    rand = random.Random(seed)
+    today = datetime.now()
+    booked = failed = 0
+    with app.app_context():
+        for _ in range(attempts):
+            start = today + timedelta(days=rand.randrange(days))
+            end = start + timedelta(days=rand.randint(1, 3))
+            try:
+                Booking.book_listing(buyer_id, owner_id,
+                                     rand.choice(listing_ids),
+                                     start.strftime('%Y-%m-%d'),
+                                     end.strftime('%Y-%m-%d'))
+                booked += 1
+            except ValueError:
+                failed += 1
+    results.append((booked, failed))
+
+
+def verify(owner_id, buyer_ids):
+    """Checks that no night is booked twice and that balances add up.
+
+    Returns a list of problems found, empty when the data is consistent.
+    """
+    problems = []
+    with app.app_context():
+        bookings = database.Booking.query.order_by(
+            database.Booking.listing_id,
+            database.Booking.start_date).all()
+        for prev, curr in zip(bookings, bookings[1:]):
+            if (prev.listing_id == curr.listing_id
+                    and curr.start_date < prev.end_date):
+                problems.append(f"Double booking: {prev} and {curr}")
+
+        total = sum(u.balance for u in database.User.query.filter(
+            database.User.id.in_(buyer_ids + [owner_id])))
+        # Balances are stored in cents
+        expected = START_BALANCE * 100 * (len(buyer_ids) + 1)
+        if total != expected:
+            problems.append(f"Balances sum to {total}, expected {expected}")
+
+        for user_id, balance, total in ledger.reconcile()[1]:
+            problems.append(f"User {user_id} balance {balance} does not "
+                            f"match its ledger total {total}")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--attempts', type=int, default=50,
+                        help='booking attempts per thread')
+    parser.add_argument('--listings', type=int, default=1,
+                        help='listings to spread bookings over')
+    parser.add_argument('--days', type=int, default=365,
+                        help='how far ahead stays may start')
+    parser.add_argument('--seed', type=int, default=327)
+    args = parser.parse_args(argv)
+
+    owner_id, buyer_ids, listing_ids = setup(args.threads, args.listings)
+    results = []
+    threads = [threading.Thread(target=buyer_thread,
+                                args=(buyer_id, owner_id, listing_ids,
+                                      args.attempts, args.days,
+                                      args.seed + i, results))
+               for i, buyer_id in enumerate(buyer_ids)]
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    booked = sum(r[0] for r in results)
+    failed = sum(r[1] for r in results)
+    print(f"threads={args.threads} listings={args.listings} "
+          f"elapsed={elapsed:.2f}s")
+    print(f"attempts/s={(booked + failed) / elapsed:.1f} "
+          f"bookings/s={booked / elapsed:.1f} "
+          f"booked={booked} rejected={failed}")
+
+    problems = verify(owner_id, buyer_ids)
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,50 @@
+"""
+Import and startup time benchmark.
+
+Times, in fresh interpreters, importing the domain layer on its own and
+building an app with create_app, so slow imports show up before they
+reach every CLI command, test run and worker boot.
+
+    python -m qbay_bench.import_time --runs 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+STAGES = {
+    'import domain': "import qbay.user, qbay.listing, qbay.booking",
+    'create app': ("from qbay.database import create_app\n"
+                   "create_app()"),
+}
+
+TIMER = ("import time\n"
+         "began = time.perf_counter()\n"
+         "{code}\n"
+         "print(time.perf_counter() - began)")
+
+
+def time_stage(code, env):
+    """Runs code in a new interpreter and returns its duration in ms"""
+    result = subprocess.run([sys.executable, "-c", TIMER.format(code=code)],
+                            env=env, check=True, capture_output=True,
+                            text=True)
+    return float(result.stdout.strip().splitlines()[-1]) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    for stage, code in STAGES.items():
+        times = [time_stage(code, env) for _ in range(args.runs)]
+        print(f"{stage}: median={statistics.median(times):.1f}ms "
+              f"min={min(times):.1f}ms max={max(times):.1f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,382 @@
+"""
+HTTP load test.
+
+Seeds a throwaway database with funded users, each owning one listing,
+starts the production server on it (`python -m qbay serve`) and drives the
+real routes from concurrent virtual users, each logged in with its own
+session cookie. Traffic is drawn from a weighted mix of routes. Reports
+throughput, p50/p95/p99 latency and error rate per route; a response is an
+error when its status is not the one the route answers with on success.
+
+The contention scenario has every virtual user book short stays on the
+same listing. Either way, the bookings are checked afterwards: no night
+may be booked twice and every balance must match the balance ledger.
+
+    python -m qbay_bench.load --users 32 --duration 30
+    python -m qbay_bench.load --mix home=5,booking_post=1 --workers 4
+    python -m qbay_bench.load --scenario contention --users 32
+"""
+import argparse
+import http.client
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+from qbay import database, ledger, search
+from qbay.database import app, db
+from qbay_bench import percentile
+
+PASSWORD = "Password123!"
+BALANCE = 10 ** 9
+
+# Route, method and the status it answers with on success
+ROUTES = {
+    'register': ('POST /register', 302),
+    'login': ('POST /login', 303),
+    'home': ('GET /', 200),
+    'booking_get': ('GET /booking/<id>', 200),
+    'booking_post': ('POST /booking/<id>', 200),
+    'create_listing': ('POST /create_listing', 302),
+    'update_listing': ('POST /update_listing/<id>', 200),
+}
+MIX = {'home': 40, 'booking_get': 20, 'booking_post': 10, 'login': 10,
+       'update_listing': 10, 'register': 5, 'create_listing': 5}
+SCENARIOS = {'mix': None, 'contention': {'booking_post': 1}}
+
+
+def parse_mix(value):
+    """Parses a traffic mix such as home=5,booking_post=1"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ROUTES:
+            raise argparse.ArgumentTypeError(f"Unknown route: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def populate(users, seed, batch_size=10000):
+    """Bulk inserts funded users, each owning one listing with a whole
+    dollar price.
+
+    Returns {listing id: price in dollars}.
+    """
+    rand = random.Random(seed)
+    prices = {i: rand.randrange(10, 200) for i in range(1, users + 1)}
+    with app.app_context():
+        database.bulk_insert(database.User, (
+            {'id': i, 'username': f"Load {i}",
+             'email': f"load{i}@bench.qbay", 'password': PASSWORD,
+             'postal_code': '', 'billing_address': '', 'balance': BALANCE}
+            for i in prices), batch_size)
+        database.bulk_insert(database.Listing, (
+            {'id': i, 'title': f"Load listing {i}",
+             'description': f"A listing for load testing, number {i}",
+             'price': price * 100, 'address': f"{i} Load Street",
+             'date_created': '2022-11-01',
+             'last_modified_date': '2022-11-01', 'owner_id': i}
+            for i, price in prices.items()), batch_size)
+        for first in range(1, users + 1, batch_size):
+            ids = range(first, min(first + batch_size, users + 1))
+            search.index_listings(ids)
+            ledger.open_accounts(ids)
+        db.session.commit()
+    return prices
+
+
+class Stats:
+    """Latencies and outcomes of the requests made, per route"""
+
+    def __init__(self):
+        self.latencies = {name: [] for name in ROUTES}
+        self.errors = {name: 0 for name in ROUTES}
+        self.booked = {}  # listing id -> stays reported booked
+        self._lock = threading.Lock()
+
+    def record(self, name, milliseconds, ok):
+        with self._lock:
+            self.latencies[name].append(milliseconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def record_booking(self, listing_id):
+        with self._lock:
+            self.booked[listing_id] = self.booked.get(listing_id, 0) + 1
+
+
+class VirtualUser:
+    """One logged in user sending requests over its own connections.
+
+    params:
+    - number: The seeded user and listing this virtual user owns (int)
+    - server: (host, port) of the server under test (tuple)
+    - listings: Ids of the listings it may book (list)
+    - prices: {listing id: price in dollars} (dict)
+    - days: How far ahead the stays it books may start (int)
+    - stats: Where requests are recorded (Stats)
+    """
+
+    def __init__(self, number, server, listings, prices, days, stats,
+                 seed):
+        self.number = number
+        self.server = server
+        self.listings = listings
+        self.prices = prices
+        self.days = days
+        self.stats = stats
+        self.rand = random.Random(seed)
+        self.cookie = None
+        self.sent = 0
+
+    def request(self, name, method, path, form=None):
+        """Sends one request and records it under name.
+
+        Returns (status, body), status 0 if the request failed.
+        """
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        connection = http.client.HTTPConnection(*self.server, timeout=60)
+        began = time.perf_counter()
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            status, text = response.status, response.read()
+            cookie = response.getheader('Set-Cookie')
+        except (OSError, http.client.HTTPException):
+            status, text, cookie = 0, b'', None
+        finally:
+            connection.close()
+        self.stats.record(name, (time.perf_counter() - began) * 1000,
+                          status == ROUTES[name][1])
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        self.sent += 1
+        return status, text.decode('utf-8', 'replace')
+
+    def login(self):
+        self.request('login', 'POST', '/login',
+                     {'email': f"load{self.number}@bench.qbay",
+                      'password': PASSWORD})
+
+    def register(self):
+        name = f"{self.number} {self.sent}"
+        self.request('register', 'POST', '/register',
+                     {'email': f"new{name.replace(' ', '.')}@bench.qbay",
+                      'username': f"New {name}", 'password': PASSWORD,
+                      'password2': PASSWORD})
+
+    def home(self):
+        self.request('home', 'GET', '/')
+
+    def booking_get(self):
+        self.request('booking_get', 'GET',
+                     f"/booking/{self.rand.choice(self.listings)}")
+
+    def booking_post(self):
+        listing_id = self.rand.choice(self.listings)
+        start = date.today() + timedelta(days=self.rand.randint(
+            1, self.days))
+        end = start + timedelta(days=self.rand.randint(1, 3))
+        _, text = self.request('booking_post', 'POST',
+                               f"/booking/{listing_id}",
+                               {'trip-start': start.isoformat(),
+                                'trip-end': end.isoformat()})
+        if "Booking Successful" in text:
+            self.stats.record_booking(listing_id)
+
+    def create_listing(self):
+        name = f"{self.number} {self.sent}"
+        self.request('create_listing', 'POST', '/create_listing',
+                     {'title': f"Created listing {name}",
+                      'description': f"A listing created under load {name}",
+                      'price': '50', 'address': f"{name} Load Street"})
+
+    def update_listing(self):
+        # Only the description changes, the price may only ever go up
+        self.request('update_listing', 'POST',
+                     f"/update_listing/{self.number}",
+                     {'title': f"Load listing {self.number}",
+                      'description': f"Updated under load, request "
+                                     f"{self.sent}",
+                      'price': str(self.prices[self.number]),
+                      'address': f"{self.number} Load Street"})
+
+    def run(self, mix, deadline, think):
+        self.login()
+        names, weights = list(mix), list(mix.values())
+        while time.monotonic() < deadline:
+            getattr(self, self.rand.choices(names, weights)[0])()
+            if think:
+                time.sleep(self.rand.uniform(0, 2 * think))
+
+
+def start_server(port, workers, threads):
+    """Starts `python -m qbay serve` on the bench database and waits until
+    it answers.
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'qbay', 'serve', '--host', '127.0.0.1',
+         '--port', str(port), '--workers', str(workers), '--threads',
+         str(threads), '--max-requests', '0'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    give_up = time.monotonic() + 30
+    while time.monotonic() < give_up:
+        if process.poll() is not None:
+            raise RuntimeError("The server exited on start up")
+        connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                timeout=1)
+        try:
+            connection.request('GET', '/login')
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+        finally:
+            connection.close()
+    process.terminate()
+    raise RuntimeError("The server did not start within 30 s")
+
+
+def verify(stats):
+    """Checks that no night is booked twice, that every booking reported
+    to a client was stored and that balances match the ledger.
+
+    Returns a list of problems found, empty when the data is consistent.
+    """
+    problems = []
+    with app.app_context():
+        bookings = database.Booking.query.order_by(
+            database.Booking.listing_id,
+            database.Booking.start_date).all()
+        for prev, curr in zip(bookings, bookings[1:]):
+            if (prev.listing_id == curr.listing_id
+                    and curr.start_date < prev.end_date):
+                problems.append(f"Double booking: {prev} and {curr}")
+
+        stored = {}
+        for booking in bookings:
+            stored[booking.listing_id] = stored.get(booking.listing_id,
+                                                    0) + 1
+        for listing_id, booked in stats.booked.items():
+            if stored.get(listing_id, 0) < booked:
+                problems.append(
+                    f"Listing {listing_id}: {booked} bookings reported, "
+                    f"{stored.get(listing_id, 0)} stored")
+
+        for user_id, balance, total in ledger.reconcile()[1]:
+            problems.append(f"User {user_id} balance {balance} does not "
+                            f"match its ledger total {total}")
+    return problems
+
+
+def summarize(stats, elapsed):
+    """Returns {route: statistics} of the routes that were requested"""
+    results = {}
+    for name, latencies in stats.latencies.items():
+        if not latencies:
+            continue
+        results[ROUTES[name][0]] = {
+            'requests': len(latencies),
+            'requests_per_sec': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'errors': stats.errors[name],
+            'error_rate': round(stats.errors[name] / len(latencies), 4),
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--scenario', choices=SCENARIOS, default='mix')
+    parser.add_argument('--mix', type=parse_mix,
+                        help='route weights, e.g. home=5,booking_post=1 '
+                             f"(routes: {', '.join(ROUTES)})")
+    parser.add_argument('--users', type=int, default=16,
+                        help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=20,
+                        help='seconds to send traffic for')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean pause between requests in seconds')
+    parser.add_argument('--days', type=int, default=None,
+                        help='how far ahead stays may start (default 365, '
+                             '14 for contention)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='server worker processes')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='request threads per server worker')
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--seed', type=int, default=327)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--max-error-rate', type=float, default=0.01,
+                        help='fail when more requests than this fraction '
+                             'are errors')
+    args = parser.parse_args(argv)
+    mix = args.mix or SCENARIOS[args.scenario] or MIX
+    contention = args.scenario == 'contention'
+    days = args.days or (14 if contention else 365)
+
+    prices = populate(args.users, args.seed)
+    server = start_server(args.port, args.workers, args.threads)
+    stats = Stats()
+    try:
+        listings = [1] if contention else list(prices)
+        deadline = time.monotonic() + args.duration
+        users = [VirtualUser(i, ('127.0.0.1', args.port), listings, prices,
+                             days, stats, args.seed + i) for i in prices]
+        threads = [threading.Thread(target=user.run,
+                                    args=(mix, deadline, args.think))
+                   for user in users]
+        began = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - began
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = summarize(stats, elapsed)
+    requests = sum(r['requests'] for r in results.values())
+    errors = sum(r['errors'] for r in results.values())
+    print(f"scenario={args.scenario} users={args.users} "
+          f"workers={args.workers} threads={args.threads} "
+          f"elapsed={elapsed:.1f}s")
+    print(f"{'route':28} {'requests':>8} {'req/s':>8} {'p50':>8} "
+          f"{'p95':>8} {'p99':>8} {'errors':>7}")
+    for route, result in results.items():
+        print(f"{route:28} {result['requests']:>8} "
+              f"{result['requests_per_sec']:>8.1f} "
+              f"{result['p50_ms']:>6.1f}ms {result['p95_ms']:>6.1f}ms "
+              f"{result['p99_ms']:>6.1f}ms {result['error_rate']:>7.1%}")
+    print(f"total: {requests / elapsed:.1f} req/s, {errors} errors, "
+          f"{sum(stats.booked.values())} stays booked")
+
+    problems = verify(stats)
+    for problem in problems:
+        print(problem)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'scenario': args.scenario, 'mix': mix,
+                       'users': args.users, 'workers': args.workers,
+                       'threads': args.threads, 'elapsed': elapsed,
+                       'results': results, 'problems': problems},
+                      file, indent=2)
+
+    too_many_errors = errors > args.max_error_rate * max(requests, 1)
+    return 1 if problems or too_many_errors else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
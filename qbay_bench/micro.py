@@ -0,0 +1,243 @@
+"""
+Domain layer microbenchmarks.
+
+Fills a throwaway database with a deterministic synthetic dataset of the
+given scale (users, listings and booked ranges), then times the hot paths
+of the domain layer one call at a time, each in a fresh app context like a
+request. Prints a table, optionally writes the results as JSON, and with a
+baseline from an earlier --json run flags every benchmark whose median
+got slower than the tolerance allows.
+
+    python -m qbay_bench.micro --scale 100k --json results.json
+    python -m qbay_bench.micro --scale 100k --baseline results.json
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+from qbay import database, search
+from qbay.database import app, db
+from qbay.user import User, user_cache
+from qbay.listing import Listing, card_cache, feed_cache
+from qbay.booking import Booking
+from qbay_bench import percentile
+
+PASSWORD = "Password123!"
+BALANCE = 10 ** 9
+SCALES = {'k': 1000, 'm': 1000000}
+
+
+def parse_scale(value):
+    """Parses a row count such as 1000, 100k or 1m"""
+    value = value.strip().lower()
+    if value[-1:] in SCALES:
+        return int(float(value[:-1]) * SCALES[value[-1]])
+    return int(value)
+
+
+def populate(scale, seed, batch_size=10000):
+    """Bulk inserts scale users, each owning one listing, and up to three
+    booked ranges per listing in 2030.
+    """
+    rand = random.Random(seed)
+
+    def users():
+        for i in range(1, scale + 1):
+            yield {'id': i, 'username': f"User {i}",
+                   'email': f"user{i}@bench.qbay", 'password': PASSWORD,
+                   'postal_code': '', 'billing_address': '',
+                   'balance': BALANCE}
+
+    def listings():
+        for i in range(1, scale + 1):
+            yield {'id': i, 'title': f"Listing {i}",
+                   'description': f"A synthetic listing number {i}",
+                   'price': rand.randrange(1000, 100000, 100),
+                   'address': f"{i} Bench Street",
+                   'date_created': '2022-11-01',
+                   'last_modified_date': '2022-11-01', 'owner_id': i}
+
+    def ranges():
+        for i in range(1, scale + 1):
+            day = date(2030, 1, 1)
+            for _ in range(rand.randint(0, 3)):
+                start = day + timedelta(days=rand.randint(0, 30))
+                day = start + timedelta(days=rand.randint(1, 7))
+                yield {'listing_id': i, 'start_date': start.isoformat(),
+                       'end_date': day.isoformat()}
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        database.bulk_insert(database.User, users(), batch_size)
+        database.bulk_insert(database.Listing, listings(), batch_size)
+        database.bulk_insert(database.BookedRange, ranges(), batch_size)
+        Listing.refresh_free_windows()
+        for first in range(1, scale + 1, batch_size):
+            search.index_listings(
+                range(first, min(first + batch_size, scale + 1)))
+        db.session.commit()
+
+
+def benchmarks(scale):
+    """Returns {name: function(rand, i)} of the paths to time"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = 1
+
+    def existing_user(rand):
+        return rand.randint(1, scale)
+
+    def register(rand, i):
+        assert User.register(f"New {i}", f"new{i}@bench.qbay", PASSWORD)
+
+    def login(rand, i):
+        User.login(f"user{existing_user(rand)}@bench.qbay", PASSWORD)
+
+    def query_user(rand, i):
+        User.query_user(existing_user(rand)).balance
+
+    def query_user_cached(rand, i):
+        User.query_user(existing_user(rand) % 100 + 1, cached=True).balance
+
+    def create_listing(rand, i):
+        owner = User.query_user(existing_user(rand))
+        Listing.create_listing(f"Created {i}", f"A created listing {i} ok",
+                               50, owner)
+
+    def valid_title(rand, i):
+        # Alternates titles that are taken and titles that are free
+        Listing.valid_title(f"Listing {existing_user(rand)}" if i % 2
+                            else f"Free title {i}")
+
+    def find_min_booking_date(rand, i):
+        Listing.query_listing(existing_user(rand)).find_min_booking_date()
+
+    def book_listing(rand, i):
+        listing_id = i % scale + 1
+        buyer_id = listing_id % scale + 1
+        start = date(2040, 1, 1) + timedelta(days=2 * (i // scale))
+        Booking.book_listing(buyer_id, listing_id, listing_id,
+                             start.isoformat(),
+                             (start + timedelta(days=1)).isoformat())
+
+    def home_cold(rand, i):
+        feed_cache.clear(counters=False)
+        card_cache.clear(counters=False)
+        user_cache.clear(counters=False)
+        assert client.get("/").status_code == 200
+
+    def home_warm(rand, i):
+        assert client.get("/").status_code == 200
+
+    return {f.__name__: f for f in (
+        register, login, query_user, query_user_cached, create_listing,
+        valid_title, find_min_booking_date, book_listing, home_cold,
+        home_warm)}
+
+
+def run(function, ops, seed):
+    """Calls function ops times after a short warm-up and returns its
+    latency statistics in milliseconds.
+    """
+    rand = random.Random(seed)
+    for i in range(ops, ops + min(ops // 10, 20)):
+        with app.app_context():
+            function(rand, i)
+    latencies = []
+    for i in range(ops):
+        with app.app_context():
+            began = time.perf_counter()
+            function(rand, i)
+            latencies.append((time.perf_counter() - began) * 1000)
+    total = sum(latencies) / 1000
+    return {'ops': ops, 'ops_per_sec': round(ops / total, 1),
+            'p50_ms': round(statistics.median(latencies), 4),
+            'p95_ms': round(percentile(latencies, 0.95), 4),
+            'max_ms': round(max(latencies), 4)}
+
+
+def compare(results, baseline, tolerance, min_delta_ms=0.0):
+    """Returns {name: change} for every benchmark whose median latency
+    grew by more than tolerance (a fraction) over the baseline, and by more
+    than min_delta_ms, so jitter on sub-millisecond calls is not flagged.
+    """
+    regressions = {}
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before and before['p50_ms'] > 0:
+            change = result['p50_ms'] / before['p50_ms'] - 1
+            delta = result['p50_ms'] - before['p50_ms']
+            if change > tolerance and delta > min_delta_ms:
+                regressions[name] = change
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--scale', default='1k',
+                        help='users and listings to create, e.g. 1k, 100k, '
+                             '1m')
+    parser.add_argument('--ops', type=int, default=200,
+                        help='timed calls per benchmark')
+    parser.add_argument('--only', action='append', default=[],
+                        help='run only this benchmark (repeatable)')
+    parser.add_argument('--seed', type=int, default=327)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='results file of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed median slowdown over the baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=0.2,
+                        help='smallest median slowdown in ms to flag')
+    args = parser.parse_args(argv)
+    scale = parse_scale(args.scale)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            stored = json.load(file)
+        if stored.get('scale') != scale:
+            print(f"Baseline was taken at scale {stored.get('scale')}",
+                  file=sys.stderr)
+        baseline = stored['results']
+
+    began = time.perf_counter()
+    populate(scale, args.seed)
+    print(f"Populated {scale} users and listings in "
+          f"{time.perf_counter() - began:.1f}s")
+
+    results = {}
+    for name, function in benchmarks(scale).items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = run(function, args.ops, args.seed)
+        result = results[name]
+        line = (f"{name:24} {result['ops_per_sec']:>10.1f} ops/s  "
+                f"p50={result['p50_ms']:.3f}ms  p95={result['p95_ms']:.3f}ms")
+        if name in baseline:
+            line += f"  baseline p50={baseline[name]['p50_ms']:.3f}ms"
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'scale': scale, 'ops': args.ops, 'seed': args.seed,
+                       'python': platform.python_version(),
+                       'database': app.config['SQLALCHEMY_DATABASE_URI']
+                       .split(':')[0],
+                       'results': results}, file, indent=2)
+
+    regressions = compare(results, baseline, args.tolerance,
+                          args.min_delta_ms)
+    for name, change in regressions.items():
+        print(f"REGRESSION {name}: median {change:+.0%} over the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
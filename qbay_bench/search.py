@@ -0,0 +1,80 @@
+"""
+Listing search latency benchmark.
+
+Fills a throwaway database with synthetic listings, then runs random
+one- and two-word searches and reports p50/p95/p99 latency for the first
+page of results.
+
+    python -m qbay_bench.search --listings 100000 --queries 500
+"""
+import argparse
+import random
+import statistics
+import time
+
+from sqlalchemy import text
+from qbay import database
+from qbay.database import app, db
+from qbay.listing import Listing
+from qbay_bench import percentile
+
+WORDS = ("lake house cottage loft city view quiet modern cozy family "
+         "downtown beach forest mountain studio garden pool suite "
+         "historic bright spacious private harbour river campus").split()
+
+
+def populate(listings, seed, batch_size=10000):
+    """Bulk inserts synthetic listings and their full-text index rows"""
+    rand = random.Random(seed)
+
+    def rows():
+        for i in range(1, listings + 1):
+            words = rand.sample(WORDS, 8)
+            yield {'id': i, 'title': f"{' '.join(words[:3])} {i}",
+                   'description': ' '.join(words[3:] * 3),
+                   'price': 10000, 'address': f"{i} {words[0]} street",
+                   'date_created': '2022-11-01',
+                   'last_modified_date': '2022-11-01', 'owner_id': 1}
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        database.bulk_insert(database.Listing, rows(), batch_size)
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(text(
+                "INSERT INTO listings_fts(rowid, title, description, "
+                "address) SELECT id, title, description, address "
+                "FROM listings"))
+        db.session.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--listings', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=327)
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    populate(args.listings, args.seed)
+    print(f"listings={args.listings} "
+          f"populated in {time.perf_counter() - began:.1f}s")
+
+    rand = random.Random(args.seed)
+    latencies = []
+    with app.app_context():
+        for _ in range(args.queries):
+            query = ' '.join(rand.sample(WORDS, rand.randint(1, 2)))
+            began = time.perf_counter()
+            Listing.search(query, 1, args.page_size)
+            latencies.append((time.perf_counter() - began) * 1000)
+    print(f"queries={args.queries} "
+          f"p50={statistics.median(latencies):.2f}ms "
+          f"p95={percentile(latencies, 0.95):.2f}ms "
+          f"p99={percentile(latencies, 0.99):.2f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
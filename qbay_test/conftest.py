@@ -4,7 +4,12 @@ import pytest
 import tempfile
 import threading
 from werkzeug.serving import make_server
-from qbay.database import app
+
+# Check the queries of every test, see no_new_n_plus_one below
+os.environ.setdefault('diagnostics', '1')
+os.environ.setdefault('n_plus_one', '5')
+
+from qbay.database import app  # noqa: E402
 '''
 This file defines what to do BEFORE running any test cases:
 '''
@@ -28,6 +33,27 @@ def pytest_sessionfinish():
     pass
 
 
+# N+1 query patterns the suite is known to run into, as
+# (endpoint, statement shape)
+KNOWN_N_PLUS_ONE = set()
+
+
+@pytest.fixture(autouse=True)
+def no_new_n_plus_one():
+    '''
+    Fails a test whose requests ran the same statement n_plus_one times
+    or more (see qbay/diagnostics.py), unless the pattern is known.
+    '''
+    detector = app.extensions.get('qbay_diagnostics')
+    seen = set(detector.findings) if detector else set()
+    yield
+    if detector:
+        new = [finding for key, finding in list(detector.findings.items())
+               if key not in seen and finding.kind == 'n+1' and
+               (finding.scope, finding.shape) not in KNOWN_N_PLUS_ONE]
+        assert not new, f"New N+1 query patterns: {new}"
+
+
 base_url = 'http://127.0.0.1:{}'.format(8081)
 
 
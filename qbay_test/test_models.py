@@ -1,16 +1,25 @@
 import unittest
 
 from qbay import database
+from unittest import mock
 from flask import Flask
-from sqlalchemy import exc
-from qbay.user import User
+from sqlalchemy import create_engine, event, exc, inspect, text
+from qbay.user import User, user_cache
 from qbay.database import app, db
 from qbay.review import Review
-from qbay.listing import Listing
+from qbay.listing import Listing, card_cache, feed_cache
 from qbay.booking import Booking
 from datetime import datetime
 from datetime import datetime, timedelta
 import pytest
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from qbay import diagnostics, importer, ledger, metrics, migrations
+from qbay.dispatcher import BookingDispatcher
 
 
 """
@@ -268,7 +277,7 @@ class UnitTest(unittest.TestCase):
         User.register("u10", "test10@test.com", "Onetwo!")
         user = database.User.query.get(1)
         assert user is not None
-        assert user.balance == 100
+        assert user.balance == 10000  # $100 in cents
 
     def test_r2_1_login(self):
         """Test if user can log in using her/his email address and the 
@@ -899,6 +908,777 @@ class UnitTest(unittest.TestCase):
             Booking.book_listing(fred.id, bob.id, listing.id, "2022-12-02",
                                  "2022-12-04")
 
+    def test_booking_ranges(self):
+        """ Tests that booked nights are stored as merged half-open ranges
+        and that overlap checks and the minimum booking date use them.
+        """
+        bob, tim, listing = self.booking_helper()
+        tim.update_balance(1000)
+        today = datetime.now()
+
+        def day(offset):
+            return (today + timedelta(days=offset)).strftime('%Y-%m-%d')
+
+        Booking.book_listing(tim.id, bob.id, listing.id, day(0), day(2))
+        Booking.book_listing(tim.id, bob.id, listing.id, day(2), day(3))
+        Booking.book_listing(tim.id, bob.id, listing.id, day(5), day(6))
+
+        assert listing.booked_ranges == [(day(0), day(3)), (day(5), day(6))]
+        assert listing.booked_dates == [day(0), day(1), day(2), day(5)]
+        assert listing.overlapping_ranges(day(1), day(6)) == [
+            (day(0), day(3)), (day(5), day(6))]
+        assert listing.is_available(day(3), day(5)) is True
+        assert listing.is_available(day(4), day(6)) is False
+        assert listing.find_min_booking_date() == day(3)
+
+        Booking.book_listing(tim.id, bob.id, listing.id, day(3), day(5))
+        assert listing.booked_ranges == [(day(0), day(6))]
+        assert listing.find_min_booking_date() == day(6)
+
+        # The first free window is stored, so reading it runs no query
+        Booking.book_listing(tim.id, bob.id, listing.id, day(9), day(10))
+        listing = Listing.query_listing(listing.id)
+        statements = []
+
+        def record(conn, cursor, statement, *_):
+            statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            assert listing.find_min_booking_date() == day(6)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        assert statements == []
+        assert (listing.database_obj.next_available,
+                listing.database_obj.available_until) == (day(6), day(9))
+
+        # Freeing nights moves the window back
+        listing.release_range(day(1), day(2))
+        db.session.commit()
+        assert listing.booked_ranges == [
+            (day(0), day(1)), (day(2), day(6)), (day(9), day(10))]
+        assert listing.find_min_booking_date() == day(1)
+        listing.release_range(day(0), day(1))
+        listing.release_range(day(2), day(6))
+        db.session.commit()
+        assert listing.find_min_booking_date() == day(0)
+        assert listing.database_obj.available_until == day(9)
+        assert Listing.free_window(
+            [(day(-3), day(-1)), (day(0), day(2)), (day(2), day(4))],
+            day(0)) == (day(4), None)
+
+    def test_add_booking_date_bulk(self):
+        """ Tests that booked dates are grouped into ranges and written
+        in one batch, merging with ranges already booked.
+        """
+        bob, tim, listing = self.booking_helper()
+        nights = [datetime(2023, 3, d) for d in (1, 2, 3, 7, 9, 10)]
+        listing.add_booking_date(nights)
+        listing.add_booking_date([datetime(2023, 3, 8)])
+
+        assert listing.booked_ranges == [("2023-03-01", "2023-03-04"),
+                                         ("2023-03-07", "2023-03-11")]
+        with self.assertRaisesRegex(ValueError, "Given dates overlap"):
+            listing.valid_booking_date([datetime(2023, 3, 3)])
+        assert listing.valid_booking_date([datetime(2023, 3, 4)]) is True
+
+        rows = [{'listing_id': listing.id, 'start_date': f"2024-01-{d:02}",
+                 'end_date': f"2024-01-{d + 1:02}"} for d in range(1, 28, 2)]
+        assert database.bulk_insert(database.BookedRange, rows, 5) == 14
+        db.session.commit()
+        assert len(listing.booked_ranges) == 16
+
+    def test_listing_feed_page(self):
+        """ Tests keyset pagination of the listing feed in both
+        directions.
+        """
+        bob, tim, listing = self.booking_helper()
+        for i in range(4):
+            Listing.create_listing(f"Title {i}", "Some description that " +
+                                   "is valid length", 20, bob.database_obj)
+
+        page, prev_cursor, next_cursor = Listing.feed_page(2)
+        assert [row.title for row in page] == ["Title 3", "Title 2"]
+        assert prev_cursor is None and next_cursor is not None
+
+        page, prev_cursor, next_cursor = Listing.feed_page(
+            2, after=next_cursor)
+        assert [row.title for row in page] == ["Title 1", "Title 0"]
+        assert prev_cursor is not None and next_cursor is not None
+
+        last, _, last_next = Listing.feed_page(2, after=next_cursor)
+        assert [row.title for row in last] == ["Title"]
+        assert last_next is None
+
+        page, prev_cursor, _ = Listing.feed_page(2, before=prev_cursor)
+        assert [row.title for row in page] == ["Title 3", "Title 2"]
+        assert prev_cursor is None
+
+        assert len(Listing.feed_page(2, after="not a cursor")[0]) == 2
+
+    def test_page_query_counts(self):
+        """ Tests that the home feed and bookings page issue the same
+        number of queries however many listings and bookings they show.
+        """
+        bob, tim, listing = self.booking_helper()
+        tim.update_balance(10000)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['logged_in'] = tim.id
+
+        def count_queries(url):
+            statements = []
+
+            def record(conn, cursor, statement, *_):
+                statements.append(statement)
+            with app.app_context():
+                engine = db.engine
+            event.listen(engine, "before_cursor_execute", record)
+            try:
+                assert client.get(url).status_code == 200
+            finally:
+                event.remove(engine, "before_cursor_execute", record)
+            return len(statements)
+
+        def add_listings(first, last):
+            for i in range(first, last):
+                User.register(f"Owner {i}", f"owner{i}@gmail.com",
+                              "Password123!")
+                owner = User.login(f"owner{i}@gmail.com", "Password123!")
+                new = Listing.create_listing(
+                    f"Title {i}", "Some description that is valid length",
+                    20, owner)
+                Booking.book_listing(tim.id, owner.id, new.id,
+                                     "2030-01-01", "2030-01-02")
+
+        add_listings(0, 2)
+        home, bookings = count_queries("/"), count_queries("/user_bookings")
+        add_listings(2, 8)
+        assert count_queries("/") == home
+        assert count_queries("/user_bookings") == bookings
+
+    def test_migrate_legacy_database(self):
+        """ Tests upgrading a database created with the original,
+        unversioned schema in place.
+        """
+        path = os.path.join(tempfile.mkdtemp(), "legacy.db")
+        engine = create_engine("sqlite:///" + path)
+        with engine.begin() as conn:
+            for statement in [
+                "CREATE TABLE users (id INTEGER PRIMARY KEY, "
+                "username VARCHAR(20) NOT NULL, email VARCHAR(320) "
+                "UNIQUE NOT NULL, password VARCHAR(255) NOT NULL, "
+                "postal_code VARCHAR(7), billing_address VARCHAR(46), "
+                "balance INTEGER NOT NULL)",
+                "CREATE TABLE listings (id INTEGER PRIMARY KEY, "
+                "title VARCHAR(255) NOT NULL, description VARCHAR(5000) "
+                "NOT NULL, price INTEGER NOT NULL, address VARCHAR(5000) "
+                "NOT NULL, date_created VARCHAR(10) NOT NULL, "
+                "last_modified_date VARCHAR(10) NOT NULL, "
+                "owner_id INTEGER REFERENCES users(id))",
+                "CREATE TABLE dates (id INTEGER PRIMARY KEY, "
+                "listing_id INTEGER REFERENCES listings(id), "
+                "date VARCHAR(10) NOT NULL)",
+                "CREATE TABLE bookings (id INTEGER PRIMARY KEY, "
+                "owner_id INTEGER NOT NULL, buyer_id INTEGER, "
+                "listing_id INTEGER, start_date VARCHAR(10) NOT NULL, "
+                "end_date VARCHAR(10) NOT NULL)",
+                "CREATE TABLE reviews (id INTEGER PRIMARY KEY, "
+                "review_text VARCHAR(5000), date INTEGER NOT NULL, "
+                "user_id INTEGER, listing_id INTEGER)",
+                "INSERT INTO users VALUES (1, 'Bob', 'bob@gmail.com', "
+                "'Password123!', '', '', 100)",
+                "INSERT INTO listings VALUES (1, 'Title', 'Description', "
+                "2000, '', '2022-11-01', '2022-11-01', 1), (2, 'Title', "
+                "'Same title', 2000, '', '2022-11-02', '2022-11-02', 1)",
+                "INSERT INTO dates (listing_id, date) VALUES "
+                "(1, '2022-12-01'), (1, '2022-12-02'), (1, '2022-12-05')",
+            ]:
+                conn.execute(text(statement))
+            assert migrations.current_version(conn) == 1
+
+        assert migrations.upgrade(engine) == [2, 3, 4, 5, 6, 7, 8]
+        assert migrations.upgrade(engine) == []
+        with engine.connect() as conn:
+            assert migrations.current_version(conn) == migrations.head()
+            ranges = conn.execute(text(
+                "SELECT listing_id, start_date, end_date FROM booked_ranges "
+                "ORDER BY start_date")).all()
+            assert [tuple(r) for r in ranges] == [
+                (1, "2022-12-01", "2022-12-03"),
+                (1, "2022-12-05", "2022-12-06")]
+            assert conn.execute(text(
+                "SELECT title FROM listings ORDER BY id")).scalars().all() \
+                == ["Title", "Title 2"]
+            assert conn.execute(text(
+                "SELECT rowid FROM listings_fts WHERE listings_fts "
+                "MATCH 'description'")).scalar() == 1
+            assert tuple(conn.execute(text(
+                "SELECT user_id, delta, reason FROM balance_ledger"
+            )).one()) == (1, 10000, "opening")
+            # Every booking is in the past, so both listings are free now
+            today = datetime.now().strftime('%Y-%m-%d')
+            assert conn.execute(text(
+                "SELECT next_available, available_until FROM listings"
+            )).all() == [(today, None), (today, None)]
+
+        inspector = inspect(engine)
+        assert not inspector.has_table("dates")
+        indexes = {i["name"]: i for i in inspector.get_indexes("listings")}
+        assert "ix_listings_title" not in indexes
+        assert indexes["uq_listings_title"]["unique"]
+        assert "ix_bookings_buyer_id" in {
+            i["name"] for i in inspector.get_indexes("bookings")}
+        engine.dispose()
+
+    def test_reset_database(self):
+        """ Tests that resetting the database removes all data and leaves
+        the schema at the latest version.
+        """
+        User.register("Bob", "bob@gmail.com", "Password123!")
+        db.session.remove()
+        migrations.reset(db.engine)
+
+        assert database.User.query.count() == 0
+        with db.engine.connect() as conn:
+            assert migrations.current_version(conn) == migrations.head()
+        assert migrations.upgrade(db.engine) == []
+
+    def test_create_app_isolated(self):
+        """ Tests that apps from create_app are bound to their own
+        database, and that importing the domain layer builds no app.
+        """
+        path = os.path.join(tempfile.mkdtemp(), "isolated.db")
+        other = database.create_app(
+            {'SQLALCHEMY_DATABASE_URI': "sqlite:///" + path})
+        User.register("Bob", "bob@gmail.com", "Password123!")
+        with other.app_context():
+            assert database.User.query.count() == 0
+            assert User.register("Bob", "bob@gmail.com", "Password123!")
+            assert database.User.query.count() == 1
+
+        code = ("import qbay.user, qbay.listing, qbay.booking\n"
+                "from qbay import database\n"
+                "assert database._app is None")
+        subprocess.run([sys.executable, "-c", code], check=True)
+
+    def test_user_cache(self):
+        """ Tests that cached user lookups skip the database and that
+        updating a user drops the stale entry.
+        """
+        bob, tim, listing = self.booking_helper()
+        user_cache.clear()
+        statements = []
+
+        def record(conn, cursor, statement, *_):
+            statements.append(statement)
+
+        with app.app_context():
+            assert User.query_user(tim.id, cached=True).username == "Tim"
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            with app.app_context():
+                cached = User.query_user(tim.id, cached=True)
+                assert cached.username == "Tim"
+                assert cached.balance == 100
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        assert statements == []
+        assert user_cache.hits == 1 and user_cache.misses == 1
+
+        tim.update_username("Timothy")
+        with app.app_context():
+            assert User.query_user(tim.id, cached=True).username == "Timothy"
+
+    def test_connection_settings(self):
+        """ Tests that SQLite connections run in WAL mode and that pool
+        statistics are exposed.
+        """
+        path = os.path.join(tempfile.mkdtemp(), "pool.db")
+        other = database.create_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite:///" + path,
+            'QBAY_DB_POOL_SIZE': 2, 'QBAY_DB_BUSY_TIMEOUT': 1234,
+            'QBAY_DEBUG_ENDPOINTS': True})
+        with other.app_context():
+            with db.engine.connect() as conn:
+                assert conn.exec_driver_sql(
+                    "PRAGMA journal_mode").scalar() == "wal"
+                assert conn.exec_driver_sql(
+                    "PRAGMA busy_timeout").scalar() == 1234
+                stats = database.pool_stats()
+                assert stats["size"] == 2 and stats["checked_out"] == 1
+            assert database.pool_stats()["checked_out"] == 0
+            assert database.pool_stats()["checkouts"] >= 1
+
+        client = other.test_client()
+        assert client.get("/debug/pool").get_json()["size"] == 2
+        assert app.test_client().get("/debug/pool").status_code == 404
+
+    def test_listing_search(self):
+        """ Tests ranked, paginated full-text search and that the index
+        follows listing updates.
+        """
+        bob, tim, listing = self.booking_helper()
+        lake = Listing.create_listing(
+            "Lake house", "Quiet cottage right on the water", 50,
+            bob.database_obj, "12 Shore Road")
+        Listing.create_listing(
+            "City loft", "Modern loft with a view of the lake", 50,
+            bob.database_obj, "3 Main Street")
+
+        results, has_next = Listing.search("lake")
+        assert [row.title for row in results] == ["Lake house", "City loft"]
+        assert has_next is False
+        assert [row.title for row in Listing.search("cott")[0]] == [
+            "Lake house"]
+        assert [row.title for row in Listing.search("shore quiet")[0]] == [
+            "Lake house"]
+        assert Listing.search("\"(*") == ([], False)
+
+        page, has_next = Listing.search("lake", page=1, size=1)
+        assert [row.title for row in page] == ["Lake house"] and has_next
+        page, has_next = Listing.search("lake", page=2, size=1)
+        assert [row.title for row in page] == ["City loft"]
+        assert not has_next
+
+        lake = Listing.query_listing(lake.id)
+        lake.update_title("Pond house")
+        lake.update_description("Quiet cottage next to a pond")
+        assert [row.title for row in Listing.search("pond")[0]] == [
+            "Pond house"]
+        assert [row.title for row in Listing.search("lake")[0]] == [
+            "City loft"]
+
+    def test_available_listings(self):
+        """ Tests the date-range availability search with price filters
+        and sorting.
+        """
+        bob, tim, listing = self.booking_helper()
+        cheap = Listing.create_listing(
+            "Cheap room", "A small but valid description", 15,
+            bob.database_obj)
+        pricey = Listing.create_listing(
+            "Pricey suite", "A large and valid description", 300,
+            bob.database_obj)
+        cheap.add_booking_date([datetime(2030, 5, 3)])
+        pricey.add_booking_date([datetime(2030, 5, 1)])
+
+        def titles(*args, **kwargs):
+            return [row.title for row in
+                    Listing.available(*args, **kwargs)[0]]
+
+        assert titles("2030-05-01", "2030-05-03") == ["Cheap room", "Title"]
+        assert titles("2030-05-02", "2030-05-03", sort="price_desc") == [
+            "Pricey suite", "Title", "Cheap room"]
+        assert titles("2030-05-02", "2030-05-04") == ["Title",
+                                                      "Pricey suite"]
+        assert titles("2030-05-01", "2030-05-10", min_price=16) == [
+            "Title"]
+        assert titles("2030-05-04", "2030-05-05", max_price=20) == [
+            "Cheap room", "Title"]
+
+        page, has_next = Listing.available("2030-05-04", "2030-05-05",
+                                           page=2, size=2)
+        assert [row.title for row in page] == ["Pricey suite"]
+        assert has_next is False
+        with self.assertRaisesRegex(ValueError, "Start date is same"):
+            Listing.available("2030-05-05", "2030-05-05")
+
+    def test_json_api(self):
+        """ Tests the JSON listing API and its conditional GETs. """
+        bob, tim, listing = self.booking_helper()
+        client = app.test_client()
+
+        response = client.get(f"/api/v1/listings/{listing.id}")
+        assert response.get_json()["title"] == "Title"
+        tag = response.headers["ETag"]
+        again = client.get(f"/api/v1/listings/{listing.id}",
+                           headers={"If-None-Match": tag})
+        assert again.status_code == 304 and again.data == b""
+        assert client.get("/api/v1/listings/0").status_code == 404
+
+        # Listings show their owner's username, so renaming them changes
+        # the ETag
+        bob.update_username("Robert")
+        renamed = client.get(f"/api/v1/listings/{listing.id}",
+                             headers={"If-None-Match": tag})
+        assert renamed.status_code == 200
+        assert renamed.get_json()["owner"]["username"] == "Robert"
+        assert renamed.headers["ETag"] != tag
+
+        url = f"/api/v1/listings/{listing.id}/availability"
+        free = client.get(url + "?start=2030-02-01&end=2030-02-03")
+        assert free.get_json()["available"] is True
+        tag = free.headers["ETag"]
+        Listing.query_listing(listing.id).add_booked_range("2030-02-02",
+                                                           "2030-02-05")
+        booked = client.get(url + "?start=2030-02-01&end=2030-02-03",
+                            headers={"If-None-Match": tag})
+        assert booked.status_code == 200
+        assert booked.get_json()["available"] is False
+        assert {"start": "2030-02-02", "end": "2030-02-05"} in \
+            booked.get_json()["booked"]
+        assert client.get(url + "?start=2030-02-03&end=2030-02-01"
+                          ).status_code == 400
+
+        feed = client.get("/api/v1/listings?size=1")
+        body = feed.get_json()
+        assert len(body["listings"]) == 1 and body["prev"] is None
+        assert client.get("/api/v1/listings?size=1", headers={
+            "If-None-Match": feed.headers["ETag"]}).status_code == 304
+        Listing.query_listing(body["listings"][0]["id"]).update_address(
+            "99 Changed Road")
+        assert client.get("/api/v1/listings?size=1", headers={
+            "If-None-Match": feed.headers["ETag"]}).status_code == 200
+        if body["next"]:
+            assert client.get(body["next"]).get_json()["prev"]
+
+        stays = client.get("/api/v1/listings?start=2030-02-01"
+                           "&end=2030-02-03").get_json()["listings"]
+        assert listing.id not in [row["id"] for row in stays]
+
+    def test_home_page_cache(self):
+        """ Tests that a warm home page is served without queries and that
+        listing and username changes show up straight away.
+        """
+        bob, tim, listing = self.booking_helper()
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['logged_in'] = tim.id
+        statements = []
+
+        def record(conn, cursor, statement, *_):
+            statements.append(statement)
+
+        assert b"Title" in client.get("/?size=100").data
+        hits = card_cache.hits
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            assert b"Title" in client.get("/?size=100").data
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        assert statements == []
+        assert card_cache.hits > hits and feed_cache.hits >= 1
+
+        Listing.query_listing(listing.id).update_title("Renamed title")
+        assert b"Renamed title" in client.get("/?size=100").data
+        bob.update_username("Bobby")
+        assert b"Owner: Bobby" in client.get("/?size=100").data
+        Listing.create_listing("Brand new listing",
+                               "A fresh description of valid length", 20,
+                               bob.database_obj)
+        assert b"Brand new listing" in client.get("/?size=100").data
+
+    def test_bulk_import(self):
+        """ Tests that bulk imports apply the registration, listing and
+        booking rules and report rejected records by line.
+        """
+        bob, tim, listing = self.booking_helper()
+        folder = tempfile.mkdtemp()
+        users = os.path.join(folder, "users.csv")
+        with open(users, "w") as file:
+            file.write("username,email,password\n"
+                       "Alice,alice@gmail.com,Password123!\n"
+                       "Bobby,bob@gmail.com,Password123!\n"
+                       "Carl,carl@gmail.com,short\n"
+                       "Alicia,alice@gmail.com,Password123!\n")
+        report = importer.import_file("users", users, batch_size=2)
+        assert report.imported == 1
+        assert report.errors == [(3, "Email already exists: bob@gmail.com"),
+                                 (4, "Invalid password"),
+                                 (5, "Email already exists: alice@gmail.com")]
+
+        # A user registered while a chunk is imported (as MySQL allows)
+        # keeps a single opening entry
+        bulk_insert = database.bulk_insert
+
+        def insert_racing(model, rows, *args):
+            if model is database.User:
+                racer = db.session.execute(
+                    database.User.__table__.insert(), {
+                        "username": "Racer", "email": "racer@gmail.com",
+                        "password": "Password123!", "balance": 100})
+                ledger.open_account(racer.inserted_primary_key[0], 100)
+            return bulk_insert(model, rows, *args)
+        with open(users, "w") as file:
+            file.write("username,email,password\n"
+                       "Dana,dana@gmail.com,Password123!\n")
+        with mock.patch.object(database, "bulk_insert", insert_racing):
+            assert importer.import_file("users", users).imported == 1
+        assert ledger.reconcile()[1] == []
+
+        listings = os.path.join(folder, "listings.jsonl")
+        with open(listings, "w") as file:
+            file.write(
+                '{"title": "Imported home", "price": 30, "description": '
+                '"An imported home by the lake", "owner_email": '
+                '"alice@gmail.com"}\n'
+                '{"title": "Title", "price": 30, "description": '
+                '"Title is taken already", "owner_email": "alice@gmail.com"}'
+                '\n[1, 2]\n')
+        report = importer.import_file("listings", listings)
+        assert report.imported == 1
+        assert [line for line, _ in report.errors] == [2, 3]
+        assert [row.title for row in Listing.search("lake")[0]] == [
+            "Imported home"]
+
+        bookings = os.path.join(folder, "bookings.csv")
+        with open(bookings, "w") as file:
+            file.write("buyer_email,listing_title,start_date,end_date\n"
+                       "tim@gmail.com,Imported home,2030-01-01,2030-01-03\n"
+                       "bob@gmail.com,Imported home,2030-01-02,2030-01-04\n"
+                       "tim@gmail.com,Title,2030-01-01,2030-01-02\n")
+        report = importer.import_file("bookings", bookings)
+        assert report.imported == 2
+        assert report.errors == [
+            (3, "Given dates overlap with existing bookings!")]
+        home = Listing.query_listing(
+            database.Listing.query.filter_by(title="Imported home").one().id)
+        assert home.booked_ranges == [("2030-01-01", "2030-01-03")]
+        assert not listing.is_available("2030-01-01", "2030-01-02")
+
+    def test_title_uniqueness(self):
+        """ Tests that titles are unique even when the title filter misses
+        a title, and that unseen titles are checked without a query.
+        """
+        bob, tim, listing = self.booking_helper()
+        statements = []
+
+        def record(conn, cursor, statement, *_):
+            statements.append(statement)
+
+        Listing.title_filter()
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            assert Listing.valid_title("Never used before") is True
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        assert statements == []
+        assert Listing.valid_title("Title") is False
+
+        # Another process wrote this title after the filter was loaded
+        db.session.execute(database.Listing.__table__.insert(), {
+            "title": "Taken elsewhere", "description": "x" * 30,
+            "price": 2000, "address": "", "date_created": "2022-11-01",
+            "last_modified_date": "2022-11-01", "owner_id": bob.id})
+        db.session.commit()
+        with self.assertRaisesRegex(ValueError, "Invalid Title"):
+            Listing.create_listing("Taken elsewhere",
+                                   "A description of valid length", 20,
+                                   bob.database_obj)
+        with self.assertRaisesRegex(ValueError, "Invalid Title"):
+            Listing.query_listing(listing.id).update_title("Taken elsewhere")
+        assert Listing.query_listing(listing.id).title == "Title"
+        assert Listing.title_taken("Taken elsewhere", exact=True) is True
+
+        client = app.test_client()
+        assert client.get("/api/v1/titles/available?title=Title"
+                          ).get_json()["available"] is False
+        assert client.get("/api/v1/titles/available?title=Taken%20elsewhere"
+                          ).get_json()["available"] is False
+        assert client.get("/api/v1/titles/available?title=Fresh%20one"
+                          ).get_json()["available"] is True
+        assert client.get("/api/v1/titles/available?title=%20bad"
+                          ).get_json()["reason"] == "Invalid title"
+
+    def test_balance_ledger(self):
+        """ Tests that balance changes are recorded in the ledger and that
+        reconciliation finds balances changed behind its back.
+        """
+        bob, tim, listing = self.booking_helper()
+        tim.update_balance(500)
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-03-01",
+                             "2030-03-04")
+        entries = [(e.user_id, e.delta, e.reason) for e in
+                   database.LedgerEntry.query.order_by(
+                       database.LedgerEntry.id)]
+        assert entries == [(bob.id, 10000, "opening"),
+                           (tim.id, 10000, "opening"),
+                           (tim.id, 40000, "adjustment"),
+                           (bob.id, 6000, "booking"),
+                           (tim.id, -6000, "booking")]
+        assert User.query_user(tim.id).balance == 440
+        assert User.query_user(bob.id).balance == 160
+        assert ledger.reconcile() == (2, [])
+
+        # Fractional prices move whole cents
+        cheap = Listing.create_listing("Cents", "A listing with a price in "
+                                       "cents", 10.55, bob.database_obj)
+        Booking.book_listing(tim.id, bob.id, cheap.id, "2030-03-01",
+                             "2030-03-04")
+        assert [e.delta for e in database.LedgerEntry.query.order_by(
+            database.LedgerEntry.id)][-2:] == [3165, -3165]
+        assert User.query_user(tim.id).balance == 408.35
+        assert ledger.reconcile() == (2, [])
+        with self.assertRaises(AssertionError):
+            ledger.post(tim.id, 0.5, ledger.ADJUSTMENT)
+
+        # The debit re-checks the balance in the database
+        db.session.execute(text("UPDATE users SET balance = 0 WHERE id = "
+                                f"{tim.id}"))
+        db.session.commit()
+        assert not ledger.transfer(tim.id, bob.id, 10, ledger.BOOKING)
+        db.session.rollback()
+        assert ledger.reconcile() == (2, [(tim.id, 0, 40835)])
+
+    def test_booking_dispatcher(self):
+        """ Tests that queued bookings of one listing run one at a time and
+        that their results can be waited for or polled.
+        """
+        bob, tim, listing = self.booking_helper()
+        tim.update_balance(1000)
+        dispatcher = BookingDispatcher(app, workers=2)
+        try:
+            tickets = [dispatcher.submit(tim.id, bob.id, listing.id,
+                                         "2030-04-01", f"2030-04-0{i}")
+                       for i in range(2, 8)]
+            assert all(ticket.wait(10) for ticket in tickets)
+        finally:
+            dispatcher.shutdown()
+        assert [t.status for t in tickets] == ["booked"] + ["failed"] * 5
+        assert tickets[1].message == \
+            "Given dates overlap with existing bookings!"
+        assert dispatcher.status(tickets[0].id) is tickets[0]
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['logged_in'] = tim.id
+        response = client.post(f"/booking/{listing.id}", data={
+            "trip-start": "2030-05-01", "trip-end": "2030-05-03"})
+        assert b"Booking Successful" in response.data
+        response = client.post(f"/booking/{listing.id}?wait=0", data={
+            "trip-start": "2030-05-02", "trip-end": "2030-05-04"})
+        assert response.status_code == 202
+        status = response.headers["Location"]
+        for _ in range(100):
+            body = client.get(status).get_json()
+            if body["status"] == "failed":
+                break
+            time.sleep(0.05)
+        assert body["message"] == \
+            "Given dates overlap with existing bookings!"
+        with client.session_transaction() as session:
+            session['logged_in'] = bob.id
+        assert client.get(status).status_code == 404
+
+    def test_request_profiling(self):
+        """ Tests that profiled requests report their SQL, render and app
+        time and that the slowest are kept for the debug endpoint.
+        """
+        path = os.path.join(tempfile.mkdtemp(), "profile.db")
+        other = database.create_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite:///" + path,
+            'QBAY_PROFILE': True, 'QBAY_PROFILE_SLOWEST': 2,
+            'QBAY_DEBUG_ENDPOINTS': True})
+        with other.app_context():
+            User.register("Profiled", "profiled@test.com", "Password123!")
+            user_id = User.login("profiled@test.com", "Password123!").id
+        client = other.test_client()
+        with client.session_transaction() as session:
+            session['logged_in'] = user_id
+        for _ in range(3):
+            response = client.get("/")
+        timing = dict(part.strip().split(';', 1) for part in
+                      response.headers["Server-Timing"].split(','))
+        assert set(timing) == {"sql", "render", "app", "total"}
+        assert 'queries"' in timing["sql"]
+
+        slowest = client.get("/debug/profile").get_json()["slowest"]
+        assert len(slowest) == 2
+        assert slowest[0]["total_ms"] >= slowest[1]["total_ms"]
+        assert slowest[0]["endpoint"] == "qbay.home"
+        assert slowest[0]["queries"] >= 1
+        assert "Server-Timing" not in app.test_client().get("/login").headers
+
+    def test_metrics_endpoint(self):
+        """ Tests the Prometheus metrics of requests and bookings and that
+        the metrics of other worker processes are added up.
+        """
+        client = app.test_client()
+        client.get("/login")
+        dispatcher = BookingDispatcher(app, workers=1)
+        try:
+            assert dispatcher.submit(1, 1, 1, "2030-01-01",
+                                     "2030-01-02").wait(10)
+        finally:
+            dispatcher.shutdown()
+        text = client.get("/metrics").get_data(as_text=True)
+        assert ('qbay_request_duration_seconds_bucket{endpoint='
+                '"qbay.login_get",le="+Inf"}') in text
+        assert ('qbay_bookings_total{outcome="failed",'
+                'reason="Owner and buyer are the same!"}') in text
+        assert "qbay_db_pool_checked_out " in text
+        assert metrics.booking_reason("Invalid Buyer ID: 12") == \
+            "Invalid Buyer ID"
+
+        # Files left by a running worker and by one that has exited
+        directory = tempfile.mkdtemp()
+        exited = subprocess.Popen([sys.executable, "-c", "pass"])
+        exited.wait()
+        for pid, count in ((os.getppid(), 2), (exited.pid, 3)):
+            with open(os.path.join(directory, f"worker-{pid}.json"),
+                      "w") as file:
+                json.dump({"counters": [["qbay_requests_total",
+                                         [["endpoint", "other"],
+                                          ["status", "200"]], count]],
+                           "gauges": [["qbay_requests_in_flight",
+                                       [["endpoint", "other"]], 1]]}, file)
+        other = database.create_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite:///" + os.path.join(
+                directory, "metrics.db"),
+            'QBAY_METRICS_DIR': directory})
+        total = ("qbay_requests_total",
+                 (("endpoint", "other"), ("status", "200")))
+        in_flight = ("qbay_requests_in_flight", (("endpoint", "other"),))
+        values = metrics.collect(other)
+        assert values["counters"][total] == 5
+        assert values["gauges"][in_flight] == 1
+
+        # A running worker takes over the counters of the one that exited
+        metrics.start(other)
+        metrics.shutdown(other)
+        assert not os.path.exists(
+            os.path.join(directory, f"worker-{exited.pid}.json"))
+        assert metrics.collect(other)["counters"][total] == 5
+
+    def test_query_diagnostics(self):
+        """ Tests that slow statements and statements repeated within a
+        request or scope are reported with the code that ran them.
+        """
+        path = os.path.join(tempfile.mkdtemp(), "diagnostics.db")
+        other = database.create_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite:///" + path,
+            'QBAY_DIAGNOSTICS': True, 'QBAY_SLOW_QUERY_MS': 0,
+            'QBAY_N_PLUS_ONE': 3})
+        detector = other.extensions['qbay_diagnostics']
+        with other.app_context():
+            for i in range(3):
+                User.register(f"Diag {i}", f"diag{i}@test.com",
+                              "Password123!")
+            with diagnostics.scope(other, "loop"):
+                for i in range(1, 4):
+                    User.query_user(i)
+        found = [f for f in detector.findings.values()
+                 if f.kind == "n+1"]
+        assert len(found) == 1 and found[0].scope == "loop"
+        assert found[0].count == 3
+        assert found[0].site.startswith("qbay/user.py:")
+        assert found[0].shape.startswith("SELECT users.id")
+        assert "?" in found[0].shape
+
+        # Every statement is slow here, and requests are their own scope
+        client = other.test_client()
+        for _ in range(3):
+            client.get("/api/v1/listings/1")
+        assert ("slow", "api.listing") in {
+            (f.kind, f.scope) for f in detector.findings.values()}
+        assert len(detector.findings) == len(
+            {f.key for f in detector.findings.values()})
+        assert [f.scope for f in detector.findings.values()
+                if f.kind == "n+1"] == ["loop"]
+        assert diagnostics.shape("SELECT * FROM t WHERE id IN (?, ?,?) "
+                                 "AND name = 'x'  LIMIT 10") == \
+            "SELECT * FROM t WHERE id IN (?) AND name = ? LIMIT ?"
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,59 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+
+"""
+This file tests the pre-forking production server (python -m qbay serve)
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "pre-forking needs os.fork")
+class ServerTest(unittest.TestCase):
+
+    def get(self, url, timeout=10):
+        """Requests url until the server answers, returning the status"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                with urllib.request.urlopen(url, timeout=5) as response:
+                    return response.status
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+
+    def test_serve_recycle_restart_shutdown(self):
+        port = free_port()
+        env = dict(os.environ, db_string='sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'server.db'))
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'qbay', 'serve', '--host', '127.0.0.1',
+             '--port', str(port), '--workers', '2', '--threads', '2',
+             '--max-requests', '3'], env=env)
+        url = f'http://127.0.0.1:{port}/login'
+        try:
+            # More requests than the workers' limits forces recycling
+            for _ in range(15):
+                assert self.get(url) == 200
+
+            process.send_signal(signal.SIGHUP)
+            for _ in range(3):
+                assert self.get(url) == 200
+
+            process.send_signal(signal.SIGTERM)
+            assert process.wait(timeout=30) == 0
+        finally:
+            if process.poll() is None:
+                process.kill()